@@ -0,0 +1,175 @@
+from flask import request, jsonify, session, url_for
+from sqlalchemy.orm import joinedload, selectinload
+from models import db, AudioFile, Loop, Note
+from routes import login_required, set_speed
+import math
+
+MAX_OPS = 500
+MAX_LABEL = 128
+MAX_TEXT = 512
+
+
+class OpError(Exception):
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+        self.message = message
+
+
+def _load_audio(audio_id):
+    return AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).options(
+        selectinload(AudioFile.loops), selectinload(AudioFile.notes), joinedload(AudioFile.settings)
+    ).first_or_404()
+
+
+def _etag(audio):
+    return f"{audio.id}-{audio.revision}"
+
+
+def _state(audio):
+    loops = sorted(audio.loops, key=lambda loop: (loop.start_time, loop.id))
+    notes = sorted(audio.notes, key=lambda note: (note.timestamp, note.id))
+    return {
+        'id': audio.id,
+        'revision': audio.revision,
+        'duration': audio.duration,
+        'tempo': audio.tempo,
+        'settings': {'speed': audio.settings.speed if audio.settings and audio.settings.speed else 1.0},
+        'loops': [{
+            'id': loop.id,
+            'start_time': loop.start_time,
+            'end_time': loop.end_time,
+            'label': loop.label,
+            'auto': loop.auto,
+            'clip_url': url_for('download_loop', audio_id=audio.id, loop_id=loop.id),
+        } for loop in loops],
+        'notes': [{'id': note.id, 'timestamp': note.timestamp, 'text': note.text} for note in notes],
+    }
+
+
+def _state_response(audio, status=200, **extra):
+    response = jsonify(dict(_state(audio), **extra))
+    response.status_code = status
+    response.set_etag(_etag(audio))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _number(index, op, field, required=True):
+    value = op.get(field)
+    if value is None and not required:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise OpError(index, f'{field} must be a non-negative number.')
+    return float(value)
+
+
+def _text(index, op, field, limit, required=False):
+    value = op.get(field)
+    if value is None:
+        if required:
+            raise OpError(index, f'{field} is required.')
+        return None
+    if not isinstance(value, str) or len(value) > limit or (required and not value.strip()):
+        raise OpError(index, f'{field} must be text of at most {limit} characters.')
+    return value
+
+
+def _loop_fields(index, op, loop=None):
+    start = _number(index, op, 'start_time', required=loop is None)
+    end = _number(index, op, 'end_time', required=loop is None)
+    start = loop.start_time if start is None else start
+    end = loop.end_time if end is None else end
+    if end <= start:
+        raise OpError(index, 'end_time must be after start_time.')
+    return start, end
+
+
+def _get_row(index, model, audio, op):
+    row_id = op.get('id')
+    row = db.session.get(model, row_id) if isinstance(row_id, int) and not isinstance(row_id, bool) else None
+    if row is None or row.audiofile_id != audio.id:
+        raise OpError(index, f"No {op['type']} with id {row_id!r} on this track.")
+    return row
+
+
+def _apply(index, audio, op):
+    # Returns the id of a created row, otherwise None.
+    if not isinstance(op, dict):
+        raise OpError(index, 'Each operation must be an object.')
+    action, kind = op.get('op'), op.get('type')
+    if kind == 'loop' and action == 'create':
+        start, end = _loop_fields(index, op)
+        loop = Loop(audiofile_id=audio.id, start_time=start, end_time=end,
+                    label=_text(index, op, 'label', MAX_LABEL) or '')
+        db.session.add(loop)
+        db.session.flush()
+        return loop.id
+    if kind == 'loop' and action == 'update':
+        loop = _get_row(index, Loop, audio, op)
+        loop.start_time, loop.end_time = _loop_fields(index, op, loop)
+        label = _text(index, op, 'label', MAX_LABEL)
+        if label is not None:
+            loop.label = label
+        loop.auto = False
+        return None
+    if kind == 'note' and action == 'create':
+        note = Note(audiofile_id=audio.id, timestamp=_number(index, op, 'timestamp'),
+                    text=_text(index, op, 'text', MAX_TEXT, required=True))
+        db.session.add(note)
+        db.session.flush()
+        return note.id
+    if kind == 'note' and action == 'update':
+        note = _get_row(index, Note, audio, op)
+        timestamp = _number(index, op, 'timestamp', required=False)
+        if timestamp is not None:
+            note.timestamp = timestamp
+        text = _text(index, op, 'text', MAX_TEXT)
+        if text is not None:
+            if not text.strip():
+                raise OpError(index, 'text must not be empty.')
+            note.text = text
+        return None
+    if kind in ('loop', 'note') and action == 'delete':
+        db.session.delete(_get_row(index, Loop if kind == 'loop' else Note, audio, op))
+        return None
+    if kind == 'settings' and action == 'update':
+        set_speed(audio, _number(index, op, 'speed'))
+        return None
+    raise OpError(index, f'Unsupported operation {action!r} on {kind!r}.')
+
+
+def register_api_routes(app):
+    @app.route('/api/audio/<int:audio_id>/', methods=['GET'])
+    @login_required
+    def api_audio(audio_id):
+        audio = _load_audio(audio_id)
+        return _state_response(audio).make_conditional(request)
+
+    @app.route('/api/audio/<int:audio_id>/batch', methods=['POST'])
+    @login_required
+    def api_audio_batch(audio_id):
+        # Optimistic concurrency: the client sends the ETag it last saw as
+        # If-Match and the revision is advanced with a compare-and-swap, so a
+        # batch built against stale state is rejected instead of applied.
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        if not request.if_match or request.if_match.star_tag:
+            return jsonify(error='If-Match with the current ETag is required.'), 428
+        data = request.get_json(silent=True)
+        ops = data.get('ops') if isinstance(data, dict) else None
+        if not isinstance(ops, list) or not ops or len(ops) > MAX_OPS:
+            return jsonify(error=f'Expected 1 to {MAX_OPS} operations in "ops".'), 400
+        current = request.if_match.contains(_etag(audio)) and AudioFile.query.filter_by(
+            id=audio.id, revision=audio.revision).update(
+            {AudioFile.revision: AudioFile.revision + 1}, synchronize_session=False)
+        if not current:
+            db.session.rollback()
+            return _state_response(_load_audio(audio_id), 412, error='This track was changed elsewhere.')
+        try:
+            created = [_apply(index, audio, op) for index, op in enumerate(ops)]
+        except OpError as e:
+            db.session.rollback()
+            return jsonify(error=e.message, index=e.index), 400
+        db.session.commit()
+        return _state_response(_load_audio(audio_id), created=[row_id for row_id in created if row_id is not None])
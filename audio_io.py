@@ -0,0 +1,27 @@
+import miniaudio
+import numpy as np
+
+CHUNK_FRAMES = 65536
+DecodeError = miniaudio.MiniaudioError
+
+
+def file_info(path):
+    return miniaudio.mp3_get_file_info(path)
+
+
+def stream_pcm(path, channels=1, sample_rate=None, chunk_frames=CHUNK_FRAMES):
+    if sample_rate is None:
+        sample_rate = file_info(path).sample_rate
+    stream = miniaudio.stream_file(path, output_format=miniaudio.SampleFormat.FLOAT32,
+                                   nchannels=channels, sample_rate=sample_rate,
+                                   frames_to_read=chunk_frames)
+    for chunk in stream:
+        samples = np.frombuffer(chunk, dtype=np.float32)
+        yield samples.reshape(-1, channels) if channels > 1 else samples
+
+
+def read_pcm(path, channels=1, sample_rate=None):
+    chunks = list(stream_pcm(path, channels, sample_rate))
+    if not chunks:
+        return np.zeros((0, channels) if channels > 1 else 0, dtype=np.float32)
+    return np.concatenate(chunks)
@@ -0,0 +1,172 @@
+from audio_io import stream_pcm, DecodeError
+from numpy.lib.stride_tricks import sliding_window_view
+import json
+import numpy as np
+import os
+
+SAMPLE_RATE = 22050
+N_FFT = 1024
+HOP = 512
+FPS = SAMPLE_RATE / HOP
+MIN_BPM = 70
+MAX_BPM = 200
+PRIOR_BPM = 130
+TIGHTNESS = 100
+OCTAVE_RATIO = 0.6
+METERS = (8, 6)
+PHRASE_BARS = 4
+MAX_SUGGESTIONS = 24
+
+
+def beats_path(path):
+    return os.path.splitext(path)[0] + '.beats'
+
+
+def onset_envelope(path):
+    # Spectral flux of the log-magnitude spectrum, computed chunk by chunk so
+    # memory stays proportional to the envelope rather than the decoded audio.
+    window = np.hanning(N_FFT).astype(np.float32)
+    carry = np.zeros(N_FFT - HOP, dtype=np.float32)
+    previous = None
+    flux = []
+    for chunk in stream_pcm(path, channels=1, sample_rate=SAMPLE_RATE, chunk_frames=HOP * 512):
+        buf = np.concatenate((carry, chunk))
+        count = (len(buf) - N_FFT) // HOP + 1
+        if count <= 0:
+            carry = buf
+            continue
+        frames = sliding_window_view(buf, N_FFT)[::HOP][:count]
+        spectrum = np.log1p(100 * np.abs(np.fft.rfft(frames * window, axis=1)))
+        if previous is not None:
+            spectrum = np.vstack((previous, spectrum))
+        flux.append(np.maximum(np.diff(spectrum, axis=0), 0).sum(axis=1))
+        previous = spectrum[-1:]
+        carry = buf[count * HOP:]
+    if not flux:
+        return np.zeros(0, dtype=np.float32)
+    envelope = np.concatenate(flux)
+    smoothing = int(FPS // 2) | 1
+    envelope = envelope - np.convolve(envelope, np.ones(smoothing) / smoothing, mode='same')
+    envelope = np.maximum(envelope, 0)
+    scale = envelope.std()
+    return envelope / scale if scale > 0 else envelope
+
+
+def estimate_tempo(envelope):
+    n = len(envelope)
+    if n < 2 * FPS:
+        return None
+    spectrum = np.fft.rfft(envelope - envelope.mean(), 2 * n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    lags = np.arange(int(FPS * 60 / MAX_BPM), min(int(FPS * 60 / MIN_BPM) + 1, n - 1))
+    if not len(lags):
+        return None
+    bpm = 60 * FPS / lags
+    prior = np.exp(-0.5 * (np.log2(bpm / PRIOR_BPM) / 0.9) ** 2)
+    scores = acf[lags] * prior
+    best = int(np.argmax(scores))
+    lag = float(lags[best])
+    if 0 < best < len(lags) - 1:
+        a, b, c = scores[best - 1], scores[best], scores[best + 1]
+        if a - 2 * b + c:
+            lag += 0.5 * (a - c) / (a - 2 * b + c)
+    # Accent patterns make twice the beat period score well too; if half the
+    # lag is still strongly periodic, the faster pulse is the real beat.
+    half = int(round(lag / 2))
+    if half >= lags[0] and acf[half] >= OCTAVE_RATIO * acf[int(round(lag))]:
+        lag /= 2
+    return 60 * FPS / lag
+
+
+def track_beats(envelope, bpm):
+    # Dynamic-programming beat tracker: each frame's score is its onset
+    # strength plus the best predecessor one beat period back, penalised by
+    # the squared log deviation from the estimated period.
+    period = FPS * 60 / bpm
+    n = len(envelope)
+    offsets = np.arange(-int(round(2 * period)), -int(round(period / 2)) + 1)
+    penalty = -TIGHTNESS * np.log(-offsets / period) ** 2
+    score = envelope.astype(np.float64).copy()
+    backlink = np.full(n, -1)
+    for t in range(-offsets[-1], n):
+        candidates = t + offsets
+        valid = candidates >= 0
+        weighted = np.where(valid, score[np.maximum(candidates, 0)] + penalty, -np.inf)
+        best = int(np.argmax(weighted))
+        score[t] += weighted[best]
+        backlink[t] = candidates[best]
+    tail = score[max(n - int(period), 0):]
+    beat = max(n - int(period), 0) + int(np.argmax(tail))
+    beats = []
+    while beat >= 0:
+        beats.append(beat)
+        beat = backlink[beat]
+    return np.array(beats[::-1])
+
+
+def choose_meter(envelope, beats):
+    # Raas phrases in 6 or 8 counts; pick the meter and phase whose downbeats
+    # carry the strongest accents relative to the average beat.
+    strengths = envelope[beats]
+    baseline = strengths.mean() or 1.0
+    best = (0.0, METERS[0], 0)
+    for meter in METERS:
+        if len(beats) < 2 * meter:
+            continue
+        for phase in range(meter):
+            contrast = strengths[phase::meter].mean() / baseline
+            if contrast > best[0]:
+                best = (contrast, meter, phase)
+    return best[1], best[2]
+
+
+def analyse(path):
+    envelope = onset_envelope(path)
+    bpm = estimate_tempo(envelope)
+    if bpm is None:
+        return {'tempo': None, 'meter': None, 'beats': [], 'downbeats': []}
+    beats = track_beats(envelope, bpm)
+    meter, phase = choose_meter(envelope, beats)
+    times = beats / FPS
+    if len(times) > 4:
+        bpm = 60 / np.polyfit(np.arange(len(times)), times, 1)[0]
+    return {
+        'tempo': round(float(bpm), 2),
+        'meter': meter,
+        'beats': np.round(times, 3).tolist(),
+        'downbeats': np.round(times[phase::meter], 3).tolist(),
+    }
+
+
+def suggest_loops(result, duration=None):
+    downbeats = result['downbeats']
+    suggestions = []
+    for i in range(0, len(downbeats) - PHRASE_BARS, PHRASE_BARS):
+        start, end = downbeats[i], downbeats[i + PHRASE_BARS]
+        if duration is not None and end > duration:
+            break
+        suggestions.append((start, end, f"Phrase {len(suggestions) + 1}"))
+        if len(suggestions) >= MAX_SUGGESTIONS:
+            break
+    return suggestions
+
+
+def write_analysis(path):
+    try:
+        result = analyse(path)
+    except DecodeError:
+        result = {'tempo': None, 'meter': None, 'beats': [], 'downbeats': []}
+    sidecar = beats_path(path)
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp_path, sidecar)
+    return result
+
+
+def load_analysis(path):
+    try:
+        with open(beats_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return write_analysis(path)
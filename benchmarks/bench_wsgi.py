@@ -0,0 +1,27 @@
+# The app under benchmark, plus a per-request SQL statement counter that is
+# reported back to the load generator in the X-Bench-Queries header.
+from benchmarks.seed import configure
+from flask import g, has_request_context
+from sqlalchemy import event
+import os
+
+configure(os.environ.get('BENCH_DATA_DIR', os.path.join('benchmarks', 'data')))
+
+from main import create_app
+from extensions import db
+
+app = create_app()
+with app.app_context():
+    engine = db.engine
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.bench_queries = g.get('bench_queries', 0) + 1
+
+
+@app.after_request
+def _report_queries(response):
+    response.headers['X-Bench-Queries'] = str(g.get('bench_queries', 0))
+    return response
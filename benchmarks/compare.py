@@ -0,0 +1,66 @@
+"""Compare two benchmark result files route by route.
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 20
+
+Exits with status 1 when any route's p95 latency or mean SQL statement
+count grew by more than --threshold percent, or when a route started
+returning errors.
+"""
+import argparse
+import json
+import sys
+
+
+def _change(old, new):
+    if old is None or new is None:
+        return None
+    if old == 0:
+        return 0.0 if new == 0 else float('inf')
+    return (new - old) / old * 100
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    print(f"{'route':<28} {'p50 ms':>17} {'p95 ms':>17} {'p99 ms':>17} {'sql':>13}")
+    for name in sorted(set(baseline['routes']) | set(candidate['routes'])):
+        old, new = baseline['routes'].get(name), candidate['routes'].get(name)
+        if old is None or new is None:
+            print(f"{name:<28} {'only in ' + ('candidate' if old is None else 'baseline')}")
+            continue
+        cells = []
+        for key in ('p50', 'p95', 'p99'):
+            change = _change(old['latency_ms'][key], new['latency_ms'][key])
+            cells.append(f"{new['latency_ms'][key] or 0:>8.2f} {change if change is not None else 0:>+7.1f}%")
+        sql_change = _change(old['queries']['mean'], new['queries']['mean'])
+        cells.append(f"{new['queries']['mean'] if new['queries']['mean'] is not None else '-':>6} "
+                     f"{sql_change if sql_change is not None else 0:>+5.0f}%")
+        print(f"{name:<28} " + ' '.join(cells))
+        p95_change = _change(old['latency_ms']['p95'], new['latency_ms']['p95'])
+        if p95_change is not None and p95_change > threshold:
+            regressions.append(f'{name}: p95 {p95_change:+.1f}%')
+        if sql_change is not None and sql_change > threshold:
+            regressions.append(f'{name}: SQL statements {sql_change:+.1f}%')
+        if new['errors'] and not old['errors']:
+            regressions.append(f"{name}: {new['errors']} errors")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed growth in percent')
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"baseline  {baseline['meta']['commit']}  candidate {candidate['meta']['commit']}")
+    regressions = compare(baseline, candidate, args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
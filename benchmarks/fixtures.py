@@ -0,0 +1,47 @@
+import lameenc
+import numpy as np
+import os
+
+SAMPLE_RATE = 44100
+BITRATE = 128
+
+
+def synth_track(seconds, bpm, seed=0, sample_rate=SAMPLE_RATE):
+    # A dhol-like pulse over a drone: clicks on every beat, accented every
+    # eighth count, so beat detection and loop suggestion have real work.
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+    root = 110 * 2 ** (rng.integers(0, 12) / 12)
+    signal = 0.08 * (np.sin(2 * np.pi * root * t) + 0.5 * np.sin(2 * np.pi * 1.5 * root * t))
+    signal += 0.01 * rng.standard_normal(n)
+    period = int(sample_rate * 60 / bpm)
+    hit = np.exp(-np.arange(2048) / 250) * np.sin(2 * np.pi * 180 * np.arange(2048) / sample_rate)
+    for i, start in enumerate(range(0, n, period)):
+        length = min(len(hit), n - start)
+        signal[start:start + length] += (0.8 if i % 8 == 0 else 0.45) * hit[:length]
+    stereo = np.repeat(np.clip(signal, -1, 1)[:, None], 2, axis=1)
+    return (stereo * 32767).astype('<i2')
+
+
+def encode_mp3(pcm, sample_rate=SAMPLE_RATE, bitrate=BITRATE):
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(bitrate)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(pcm.shape[1])
+    encoder.set_quality(7)
+    return bytes(encoder.encode(pcm.tobytes())) + bytes(encoder.flush())
+
+
+def write_fixtures(directory, count, seconds):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'fixture-{i:03d}.mp3')
+        if not os.path.exists(path):
+            bpm = 90 + (i * 37) % 90
+            length = seconds * (0.5 + (i % 4) / 4)
+            with open(path, 'wb') as f:
+                f.write(encode_mp3(synth_track(length, bpm, seed=i)))
+        paths.append(path)
+    return paths
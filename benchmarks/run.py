@@ -0,0 +1,410 @@
+"""Load-test every route registered by register_routes against gunicorn.
+
+    python -m benchmarks.seed --scale small
+    python -m benchmarks.run --requests 200 --concurrency 32
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+
+Requests for all routes are shuffled together and issued concurrently by
+logged-in bench users, so each route is measured under mixed load. The
+result file records p50/p95/p99 latency, throughput, status codes and SQL
+statements per request for every route, along with the commit and scale.
+"""
+from benchmarks.seed import BENCH_PASSWORD, configure
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+RETRYABLE = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+RANGE_BYTES = 64 * 1024
+
+
+class BenchUser:
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+        self.cookie = None
+        self.audio = []
+        self.teams = {}
+        self.folders = {}
+        self.disposable_audio = deque()
+        self.disposable_uploads = deque()
+        self.job_id = None
+
+
+def discover(bench_users):
+    from main import create_app
+    from sqlalchemy import func
+    from models import db, User, AudioFile, Loop, TeamMember, TeamUpload, Job, Blob, Team, Note
+    app = create_app()
+    users = []
+    with app.app_context():
+        for user in User.query.order_by(User.id).limit(bench_users):
+            bench = BenchUser(user.id, user.username)
+            audio_ids = [row.id for row in AudioFile.query.filter(
+                AudioFile.user_id == user.id, AudioFile.original_filename != 'disposable.mp3').limit(40)]
+            loops = dict(db.session.query(Loop.audiofile_id, func.min(Loop.id)).filter(
+                Loop.audiofile_id.in_(audio_ids)).group_by(Loop.audiofile_id).all())
+            bench.audio = [(audio_id, loops[audio_id]) for audio_id in audio_ids if audio_id in loops]
+            for (team_id,) in db.session.query(TeamMember.team_id).filter_by(user_id=user.id):
+                bench.teams[team_id] = [row.id for row in TeamUpload.query.filter(
+                    TeamUpload.team_id == team_id, TeamUpload.folder != 'Disposable').order_by(
+                    TeamUpload.uploaded_at.desc()).limit(50)]
+                bench.folders[team_id] = [row[0] for row in db.session.query(TeamUpload.folder).filter_by(
+                    team_id=team_id).distinct()]
+            bench.disposable_audio.extend(row.id for row in AudioFile.query.filter_by(
+                user_id=user.id, original_filename='disposable.mp3'))
+            bench.disposable_uploads.extend((row.team_id, row.id) for row in TeamUpload.query.filter_by(
+                user_id=user.id, folder='Disposable'))
+            job = Job.query.filter_by(user_id=user.id).first()
+            bench.job_id = job.id if job else None
+            if bench.audio and bench.teams:
+                users.append(bench)
+        scale = {model.__tablename__: db.session.query(func.count(model.id)).scalar()
+                 for model in (User, Team, TeamMember, TeamUpload, AudioFile, Loop, Note, Blob)}
+        min_blob = db.session.query(func.min(Blob.size)).scalar() or 0
+    if not users:
+        sys.exit('No usable bench users; run python -m benchmarks.seed first.')
+    return users, scale, min_blob
+
+
+def registered_endpoints():
+    from flask import Flask
+    from routes import register_routes
+    probe = Flask('probe')
+    register_routes(probe)
+    return {rule.endpoint for rule in probe.url_map.iter_rules()} - {'static'}
+
+
+def multipart(fields, file_field, filename, payload):
+    boundary = f'bench{random.getrandbits(64):016x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: audio/mpeg\r\n\r\n'.encode() + payload + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def form(fields):
+    return urlencode(fields).encode(), 'application/x-www-form-urlencoded'
+
+
+def build_routes(upload_payload, min_blob):
+    # name -> function(user, rng) returning (method, path, headers, body), or
+    # None when the user has nothing left to act on.
+    def team(user, rng):
+        return rng.choice(sorted(user.teams))
+
+    def team_upload_id(user, rng):
+        team_id = team(user, rng)
+        uploads = user.teams[team_id]
+        return (team_id, rng.choice(uploads)) if uploads else (team_id, None)
+
+    def ranged():
+        start = random.randrange(max(min_blob - RANGE_BYTES, 1))
+        return {'Range': f'bytes={start}-{start + RANGE_BYTES - 1}'}
+
+    def post(path, body_and_type):
+        body, content_type = body_and_type
+        return 'POST', path, {'Content-Type': content_type}, body
+
+    def delete_team_file(user, rng):
+        try:
+            team_id, upload_id = user.disposable_uploads.popleft()
+        except IndexError:
+            return None
+        return 'POST', f'/teams/{team_id}/delete/{upload_id}', {}, b''
+
+    def delete_audio(user, rng):
+        try:
+            audio_id = user.disposable_audio.popleft()
+        except IndexError:
+            return None
+        return 'POST', f'/audio/{audio_id}/delete', {}, b''
+
+    def audio(user, rng):
+        return rng.choice(user.audio)
+
+    def with_upload(path, rng, **fields):
+        return post(path, multipart(fields, 'file', f'bench-{rng.getrandbits(32):08x}.mp3', upload_payload))
+
+    return {
+        'home': lambda u, r: ('GET', '/', {}, None),
+        'register_page': lambda u, r: ('GET', '/register', {}, None),
+        'login_page': lambda u, r: ('GET', '/login', {}, None),
+        'login_page:POST': lambda u, r: post('/login', form({'username': u.username, 'password': BENCH_PASSWORD})),
+        'logout': lambda u, r: ('GET', '/logout', {}, None),
+        'create_team': lambda u, r: ('GET', '/teams/create', {}, None),
+        'join_team': lambda u, r: ('GET', '/teams/join', {}, None),
+        'team_dashboard': lambda u, r: ('GET', f'/teams/{team(u, r)}', {}, None),
+        'team_dashboard:folder': lambda u, r: (lambda t: (
+            'GET', f'/teams/{t}?' + urlencode({'folder': r.choice(u.folders[t] or ['General'])}), {}, None))(team(u, r)),
+        'team_upload': lambda u, r: ('GET', f'/teams/{team(u, r)}/upload', {}, None),
+        'team_upload:POST': lambda u, r: with_upload(f'/teams/{team(u, r)}/upload', r, folder='Bench'),
+        'download_team_file': lambda u, r: ('GET', '/teams/{}/download/{}'.format(*team_upload_id(u, r)), {}, None),
+        'download_team_file:range': lambda u, r: (
+            'GET', '/teams/{}/download/{}'.format(*team_upload_id(u, r)), ranged(), None),
+        'team_file_peaks': lambda u, r: ('GET', '/teams/{}/peaks/{}?width=1000'.format(*team_upload_id(u, r)), {}, None),
+        'analyse_team_folder': lambda u, r: post(f'/teams/{team(u, r)}/analyse', form({'folder': 'General'})),
+        'team_jobs': lambda u, r: ('GET', f'/teams/{team(u, r)}/jobs', {}, None),
+        'delete_team_file': delete_team_file,
+        'dashboard': lambda u, r: ('GET', '/dashboard', {}, None),
+        'dashboard:POST': lambda u, r: with_upload('/dashboard', r),
+        'audio_detail': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}', {}, None),
+        'audio_detail:POST': lambda u, r: post(f'/audio/{audio(u, r)[0]}', form(
+            {'form_type': 'note', 'timestamp': round(r.uniform(0, 60), 2), 'text': 'bench note'})),
+        'download_audio': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}/download', {}, None),
+        'download_audio:range': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}/download', ranged(), None),
+        'download_loop': lambda u, r: ('GET', '/audio/{}/loops/{}.mp3'.format(*audio(u, r)), {}, None),
+        'audio_rendition': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}/rendition?speed=0.75', {}, None),
+        'audio_settings': lambda u, r: post(f'/audio/{audio(u, r)[0]}/settings', form({'speed': '0.75'})),
+        'audio_peaks': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}/peaks?width=1000', {}, None),
+        'analyse_audio': lambda u, r: ('POST', f'/audio/{audio(u, r)[0]}/analyse', {}, b''),
+        'audio_jobs': lambda u, r: ('GET', f'/audio/{audio(u, r)[0]}/jobs', {}, None),
+        'job_status': lambda u, r: ('GET', f'/jobs/{u.job_id}', {}, None) if u.job_id else None,
+        'delete_audio': delete_audio,
+    }
+
+
+class Client:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        return conn
+
+    def send(self, method, path, headers, body):
+        for attempt in range(2):
+            conn = self._conn()
+            try:
+                started = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                size = len(response.read())
+                elapsed = time.perf_counter() - started
+                return response.status, size, elapsed, response.getheader('X-Bench-Queries'), \
+                    response.getheader('Set-Cookie')
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self.local.conn = None
+                # Only a keep-alive connection the server already closed is
+                # retried; the request never reached the app.
+                if attempt or not isinstance(e, RETRYABLE):
+                    raise
+
+
+def start_gunicorn(args, port):
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--threads', str(args.threads), '--worker-class', 'gthread', '--keep-alive', '30',
+               '--log-level', 'warning'] + shlex.split(args.gunicorn_args) + ['benchmarks.bench_wsgi:app']
+    env = dict(os.environ, BENCH_DATA_DIR=args.data_dir)
+    process = subprocess.Popen(command, env=env)
+    client = Client('127.0.0.1', port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'gunicorn exited with status {process.returncode}')
+        try:
+            if client.send('GET', '/', {}, None)[0] == 200:
+                return process
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    sys.exit('gunicorn did not become ready within 60s')
+
+
+def login(client, user):
+    status, _, elapsed, queries, cookie = client.send(
+        'POST', '/login', {'Content-Type': 'application/x-www-form-urlencoded'},
+        urlencode({'username': user.username, 'password': BENCH_PASSWORD}).encode())
+    if status != 302 or not cookie:
+        sys.exit(f'Login failed for {user.username} with status {status}')
+    user.cookie = cookie.split(';', 1)[0]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q / 100 * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(samples, wall):
+    latencies = [s['elapsed'] * 1000 for s in samples]
+    queries = [s['queries'] for s in samples if s['queries'] is not None]
+    statuses = defaultdict(int)
+    for s in samples:
+        statuses[str(s['status'])] += 1
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for s in samples if s['status'] is None or s['status'] >= 400),
+        'statuses': dict(statuses),
+        'throughput_rps': round(len(samples) / wall, 2) if wall else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3) if latencies else None,
+            'p95': round(percentile(latencies, 95), 3) if latencies else None,
+            'p99': round(percentile(latencies, 99), 3) if latencies else None,
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'max': round(max(latencies), 3) if latencies else None,
+        },
+        'queries': {
+            'mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'p95': percentile(queries, 95),
+            'max': max(queries) if queries else None,
+        },
+        'bytes': sum(s['bytes'] for s in samples),
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run(args):
+    users, scale, min_blob = discover(args.bench_users)
+    with open(args.upload_fixture, 'rb') as f:
+        upload_payload = f.read()
+    routes = build_routes(upload_payload, min_blob)
+    if args.routes:
+        routes = {name: build for name, build in routes.items() if name.split(':')[0] in args.routes}
+    missing = registered_endpoints() - {name.split(':')[0] for name in routes}
+    if missing and not args.routes:
+        print('warning: no load for ' + ', '.join(sorted(missing)), file=sys.stderr)
+
+    port = args.port or _free_port()
+    process = start_gunicorn(args, port) if not args.no_server else None
+    client = Client('127.0.0.1', port)
+    try:
+        for user in users:
+            login(client, user)
+        rng = random.Random(args.seed)
+        plan = []
+        for name in routes:
+            for i in range(args.warmup + args.requests):
+                plan.append((name, users[(i + len(plan)) % len(users)], i >= args.warmup))
+        warmup = [item for item in plan if not item[2]]
+        measured = [item for item in plan if item[2]]
+        rng.shuffle(measured)
+        samples = defaultdict(list)
+        lock = threading.Lock()
+
+        def issue(item):
+            name, user, record = item
+            request = routes[name](user, random.Random(rng.random()))
+            if request is None:
+                return
+            method, path, headers, body = request
+            headers = dict(headers, Cookie=user.cookie)
+            try:
+                status, size, elapsed, queries, _ = client.send(method, path, headers, body)
+            except (OSError, http.client.HTTPException):
+                status, size, elapsed, queries = None, 0, 0.0, None
+            if record:
+                with lock:
+                    samples[name].append({'status': status, 'bytes': size, 'elapsed': elapsed,
+                                          'queries': int(queries) if queries is not None else None})
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(issue, warmup))
+            started = time.perf_counter()
+            list(pool.map(issue, measured))
+            wall = time.perf_counter() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    commit, dirty = git_revision()
+    everything = [sample for route_samples in samples.values() for sample in route_samples]
+    result = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scale': scale,
+            'settings': {key: value for key, value in vars(args).items() if key not in ('output',)},
+        },
+        'total': summarize(everything, wall),
+        'routes': {name: summarize(samples[name], wall) for name in sorted(samples)},
+    }
+    output = args.output or os.path.join('benchmarks', 'results', '{}-{}.json'.format(
+        (commit or 'unknown')[:12], datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print_table(result)
+    print(f'wrote {output}')
+
+
+def print_table(result):
+    print(f"{'route':<28} {'reqs':>6} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>8} {'sql':>6}")
+    for name, stats in list(result['routes'].items()) + [('TOTAL', result['total'])]:
+        latency = stats['latency_ms']
+        print(f"{name:<28} {stats['requests']:>6} {stats['errors']:>4} {latency['p50'] or 0:>9.2f} "
+              f"{latency['p95'] or 0:>9.2f} {latency['p99'] or 0:>9.2f} {stats['throughput_rps'] or 0:>8.1f} "
+              f"{stats['queries']['mean'] if stats['queries']['mean'] is not None else '-':>6}")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'))
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per route before the run')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--bench-users', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--gunicorn-args', default='', help='extra arguments passed to gunicorn')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--no-server', action='store_true', help='use a server already listening on --port')
+    parser.add_argument('--routes', nargs='*', help='only these endpoints')
+    parser.add_argument('--upload-fixture', help='MP3 posted by the upload routes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='result file (default benchmarks/results/<commit>-<time>.json)')
+    args = parser.parse_args()
+    if args.no_server and not args.port:
+        parser.error('--no-server needs --port')
+    args.data_dir = configure(args.data_dir)
+    if args.upload_fixture is None:
+        fixtures = sorted(os.listdir(os.path.join(args.data_dir, 'fixtures')))
+        args.upload_fixture = os.path.join(args.data_dir, 'fixtures', fixtures[0])
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Seed a benchmark database and upload folder.
+
+    python -m benchmarks.seed --scale small
+    python -m benchmarks.seed --scale large --data-dir /mnt/bench
+
+Every user shares the password BENCH_PASSWORD. The first --bench-users
+users are the ones the load generator logs in as; they belong to the
+largest teams and own disposable rows for the delete routes.
+"""
+from benchmarks.fixtures import write_fixtures
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, update
+import argparse
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import time
+
+BENCH_PASSWORD = 'bench-password'
+BATCH = 20000
+SCALES = {
+    'small': dict(users=100, teams=10, uploads=2000, audio=1000, loops=10000, notes=10000),
+    'medium': dict(users=2000, teams=200, uploads=40000, audio=10000, loops=200000, notes=200000),
+    'large': dict(users=10000, teams=1000, uploads=200000, audio=50000, loops=2000000, notes=2000000),
+}
+FOLDERS = ('General', 'Garba', 'Raas', 'Dandiya', 'Warmup', 'Competition')
+
+
+def configure(data_dir):
+    # Must run before main is imported so create_app() picks these up.
+    data_dir = os.path.abspath(data_dir)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(data_dir, 'bench.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(data_dir, 'uploads')
+    os.environ.setdefault('SECRET_KEY', 'bench-secret-key')
+    os.environ.setdefault('JOBS_EAGER', '0')
+    return data_dir
+
+
+def _bulk(db, model, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(insert(model.__table__), rows[start:start + BATCH])
+    db.session.commit()
+
+
+def _timestamps(rng, count, now):
+    seconds = np.sort(rng.integers(0, 365 * 24 * 3600, count))[::-1]
+    return [now - timedelta(seconds=int(s)) for s in seconds]
+
+
+def seed(args):
+    from main import create_app
+    from extensions import bcrypt
+    from models import db, User, Team, TeamMember, TeamUpload, AudioFile, Loop, Note, Blob, Job
+    import beats
+    import blobstore
+    import mp3index
+    import renditions
+    import waveform
+
+    rng = np.random.default_rng(args.seed)
+    now = datetime.utcnow()
+    app = create_app()
+    with app.app_context():
+        if User.query.first() is not None:
+            sys.exit('Database is not empty; pass --reset to reseed.')
+        started = time.monotonic()
+        fixture_paths = write_fixtures(os.path.join(args.data_dir, 'fixtures'), args.fixtures, args.fixture_seconds)
+        blobs = []
+        for path in fixture_paths:
+            copy = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(path))
+            shutil.copyfile(path, copy)
+            blob = blobstore.store_file(copy)
+            db.session.commit()
+            stored = blobstore.absolute_path(blob.filename)
+            index = mp3index.write_index(stored)
+            waveform.write_peaks(stored)
+            beats.write_analysis(stored)
+            if args.renditions:
+                renditions.cache_for(app.config).build(stored, renditions.cache_key(blob.filename), 0.75)
+            blobs.append((blob.id, blob.filename, index.duration))
+        print(f'fixtures: {len(blobs)} in {time.monotonic() - started:.1f}s')
+
+        password_hash = bcrypt.generate_password_hash(BENCH_PASSWORD).decode('utf-8')
+        _bulk(db, User, [{'id': i + 1, 'username': f'user{i:06d}', 'email': f'user{i:06d}@bench.invalid',
+                          'password_hash': password_hash} for i in range(args.users)])
+        _bulk(db, Team, [{'id': i + 1, 'name': f'team{i:05d}', 'password_hash': password_hash,
+                          'created_by': int(rng.integers(1, args.users + 1)), 'created_at': now}
+                         for i in range(args.teams)])
+
+        # Bench users join the largest teams; everyone else joins a few at random.
+        bench_users = min(args.bench_users, args.users)
+        members = {team_id: set() for team_id in range(1, args.teams + 1)}
+        for user_id in range(1, bench_users + 1):
+            for team_id in range(1, min(args.teams, 3) + 1):
+                members[team_id].add(user_id)
+        for user_id in range(bench_users + 1, args.users + 1):
+            for team_id in rng.choice(args.teams, size=min(args.teams_per_user, args.teams), replace=False):
+                members[int(team_id) + 1].add(user_id)
+        _bulk(db, TeamMember, [{'team_id': team_id, 'user_id': user_id, 'joined_at': now}
+                               for team_id, users in members.items() for user_id in sorted(users)])
+        member_lists = {team_id: np.array(sorted(users) or [1]) for team_id, users in members.items()}
+
+        # Uploads follow a Zipf-like spread so team 1 is the big one.
+        weights = 1 / np.arange(1, args.teams + 1)
+        team_ids = rng.choice(np.arange(1, args.teams + 1), size=args.uploads, p=weights / weights.sum())
+        upload_rows = []
+        for team_id, uploaded_at in zip(team_ids, _timestamps(rng, args.uploads, now)):
+            blob_id, filename, _ = blobs[int(rng.integers(len(blobs)))]
+            upload_rows.append({
+                'team_id': int(team_id),
+                'user_id': int(rng.choice(member_lists[int(team_id)])),
+                'filename': filename,
+                'original_filename': f'track-{len(upload_rows):07d}.mp3',
+                'folder': FOLDERS[int(rng.integers(len(FOLDERS)))],
+                'uploaded_at': uploaded_at,
+                'blob_id': blob_id,
+                'tempo': round(float(rng.uniform(80, 180)), 2),
+            })
+        for user_id in range(1, bench_users + 1):
+            for i in range(args.disposable):
+                blob_id, filename, _ = blobs[i % len(blobs)]
+                upload_rows.append({'team_id': 1, 'user_id': user_id, 'filename': filename,
+                                    'original_filename': f'disposable-{user_id}-{i}.mp3', 'folder': 'Disposable',
+                                    'uploaded_at': now, 'blob_id': blob_id, 'tempo': None})
+        _bulk(db, TeamUpload, upload_rows)
+
+        audio_owners = np.concatenate((np.repeat(np.arange(1, bench_users + 1), args.audio_per_bench_user),
+                                       rng.integers(1, args.users + 1, args.audio)))
+        audio_rows = []
+        for user_id, uploaded_at in zip(audio_owners, _timestamps(rng, len(audio_owners), now)):
+            blob_id, filename, duration = blobs[int(rng.integers(len(blobs)))]
+            audio_rows.append({'id': len(audio_rows) + 1, 'user_id': int(user_id), 'filename': filename,
+                               'original_filename': f'song-{len(audio_rows):07d}.mp3', 'upload_date': uploaded_at,
+                               'blob_id': blob_id, 'duration': duration, 'tempo': round(float(rng.uniform(80, 180)), 2),
+                               'revision': 0})
+        for user_id in range(1, bench_users + 1):
+            for i in range(args.disposable):
+                blob_id, filename, duration = blobs[i % len(blobs)]
+                audio_rows.append({'id': len(audio_rows) + 1, 'user_id': user_id, 'filename': filename,
+                                   'original_filename': 'disposable.mp3',
+                                   'upload_date': now - timedelta(days=400), 'blob_id': blob_id,
+                                   'tempo': None, 'duration': duration, 'revision': 0})
+        _bulk(db, AudioFile, audio_rows)
+        audio_count = len(audio_owners)
+        durations = np.array([row['duration'] or 60.0 for row in audio_rows[:audio_count]])
+
+        # Loops and notes are spread over the non-disposable audio files, with
+        # every file getting at least one loop so the clip route has targets.
+        for model, total in ((Loop, args.loops), (Note, args.notes)):
+            owners = np.concatenate((np.arange(audio_count), rng.integers(0, audio_count, max(total - audio_count, 0))))
+            for start in range(0, len(owners), BATCH):
+                chunk = owners[start:start + BATCH]
+                times = rng.uniform(0, 1, len(chunk)) * np.maximum(durations[chunk] - 8, 1)
+                if model is Loop:
+                    rows = [{'audiofile_id': int(a) + 1, 'start_time': round(float(t), 2),
+                             'end_time': round(float(t) + 8, 2), 'label': 'Phrase', 'auto': False}
+                            for a, t in zip(chunk, times)]
+                else:
+                    rows = [{'audiofile_id': int(a) + 1, 'timestamp': round(float(t), 2), 'text': 'Watch the turn here'}
+                            for a, t in zip(chunk, times)]
+                db.session.execute(insert(model.__table__), rows)
+            db.session.commit()
+
+        _bulk(db, Job, [{'kind': 'process_blob', 'payload': json.dumps({'blob_id': blobs[0][0]}), 'status': 'done',
+                         'attempts': 1, 'max_attempts': 5, 'user_id': user_id, 'blob_id': blobs[0][0],
+                         'run_after': now, 'created_at': now, 'finished_at': now}
+                        for user_id in range(1, bench_users + 1)])
+
+        for blob_id, _, _ in blobs:
+            refs = db.session.query(func.count(TeamUpload.id)).filter_by(blob_id=blob_id).scalar() + \
+                db.session.query(func.count(AudioFile.id)).filter_by(blob_id=blob_id).scalar()
+            db.session.execute(update(Blob.__table__).where(Blob.__table__.c.id == blob_id).values(refcount=refs))
+        db.session.commit()
+        print(f'seeded in {time.monotonic() - started:.1f}s: ' + ', '.join(
+            f'{model.__tablename__}={db.session.query(func.count(model.id)).scalar()}'
+            for model in (User, Team, TeamMember, TeamUpload, AudioFile, Loop, Note)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'))
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    for field in SCALES['small']:
+        parser.add_argument(f'--{field}', type=int, help=f'override the scale preset for {field}')
+    parser.add_argument('--teams-per-user', type=int, default=3)
+    parser.add_argument('--bench-users', type=int, default=16)
+    parser.add_argument('--audio-per-bench-user', type=int, default=40)
+    parser.add_argument('--disposable', type=int, default=50, help='rows per bench user for the delete routes')
+    parser.add_argument('--fixtures', type=int, default=8)
+    parser.add_argument('--fixture-seconds', type=float, default=180)
+    parser.add_argument('--no-renditions', dest='renditions', action='store_false')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reset', action='store_true', help='delete the existing database and uploads first')
+    args = parser.parse_args()
+    for field, value in SCALES[args.scale].items():
+        if getattr(args, field) is None:
+            setattr(args, field, value)
+    args.data_dir = configure(args.data_dir)
+    if args.reset:
+        shutil.rmtree(os.environ['UPLOAD_FOLDER'], ignore_errors=True)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(os.path.join(args.data_dir, 'bench.db' + suffix))
+            except FileNotFoundError:
+                pass
+    os.makedirs(args.data_dir, exist_ok=True)
+    seed(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+from flask import current_app, redirect
+from sqlalchemy.exc import IntegrityError
+from models import db, Blob
+from extensions import instrumentation
+from byteserve import send_audio, content_disposition
+import beats
+import hashlib
+import mp3index
+import os
+import renditions
+import storage
+import tempfile
+import waveform
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def upload_root():
+    return current_app.config['UPLOAD_FOLDER']
+
+
+def absolute_path(filename):
+    # Where the local working copy and its sidecars live. It may not exist
+    # yet with a remote backend; local_path() fetches it.
+    return os.path.join(upload_root(), filename)
+
+
+def local_path(filename):
+    return storage.current().local_path(filename)
+
+
+def send(filename, download_name=None, as_attachment=False, mimetype='audio/mpeg'):
+    # With a backend that can presign, the client is redirected to fetch the
+    # bytes straight from the object store and no worker streams them.
+    backend = storage.current()
+    if current_app.config.get('STORAGE_REDIRECTS'):
+        max_age = current_app.config.get('AUDIO_CACHE_MAX_AGE', 365 * 24 * 3600)
+        url = backend.presigned_url(filename, content_type=mimetype,
+                                    disposition=content_disposition(download_name, as_attachment),
+                                    cache_control=f'private, max-age={max_age}')
+        if url is not None:
+            response = redirect(url)
+            response.headers['Cache-Control'] = 'private, no-store'
+            return response
+    return send_audio(backend.local_path(filename), download_name=download_name, as_attachment=as_attachment,
+                      mimetype=mimetype, offload=True)
+
+
+def _temp_file():
+    tmp_dir = os.path.join(upload_root(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _acquire(digest, size):
+    for _ in range(3):
+        updated = Blob.query.filter_by(digest=digest).update(
+            {Blob.refcount: Blob.refcount + 1}, synchronize_session=False)
+        if updated:
+            return Blob.query.filter_by(digest=digest).one()
+        try:
+            with db.session.begin_nested():
+                blob = Blob(digest=digest, size=size, refcount=1)
+                db.session.add(blob)
+            return blob
+        except IntegrityError:
+            continue
+    raise RuntimeError(f'could not acquire blob {digest}')
+
+
+def _place(tmp_path, digest, size):
+    blob = _acquire(digest, size)
+    backend = storage.current()
+    if backend.exists(blob.filename):
+        os.remove(tmp_path)
+    else:
+        backend.put_file(blob.filename, tmp_path)
+    return blob
+
+
+def store_stream(stream):
+    return store_spooled(spool_stream(stream))
+
+
+def spool_stream(stream):
+    # Copies the stream to a temp file and hashes it without touching the
+    # database, so a slow upload holds no write lock. Returns the
+    # (tmp_path, digest, size) that store_spooled() or discard() takes.
+    digest = hashlib.sha256()
+    size = 0
+    out, tmp_path = _temp_file()
+    try:
+        with out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def store_spooled(spooled):
+    tmp_path, digest, size = spooled
+    with instrumentation.storage('write') as op:
+        op.bytes = size
+        try:
+            return _place(tmp_path, digest, size)
+        except BaseException:
+            discard(spooled)
+            raise
+
+
+def discard(spooled):
+    try:
+        os.remove(spooled[0])
+    except FileNotFoundError:
+        pass
+
+
+def store_upload(file):
+    return store_stream(file.stream)
+
+
+def store_file(path):
+    with instrumentation.storage('write') as op:
+        digest, size = _hash_file(path)
+        op.bytes = size
+        return _place(path, digest, size)
+
+
+def release(row):
+    if row.blob_id is None:
+        return [row.filename]
+    db.session.flush()
+    Blob.query.filter_by(id=row.blob_id).update(
+        {Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    deleted = Blob.query.filter(Blob.id == row.blob_id, Blob.refcount <= 0).delete(
+        synchronize_session=False)
+    return [row.filename] if deleted else []
+
+
+def purge(filenames):
+    with instrumentation.storage('delete'):
+        _purge(filenames)
+
+
+def _purge(filenames):
+    backend = storage.current()
+    for filename in filenames:
+        path = absolute_path(filename)
+        stem, _ = os.path.splitext(os.path.basename(filename))
+        if filename.startswith('blobs/') and Blob.query.filter_by(digest=stem).first() is not None:
+            continue
+        backend.delete(filename)
+        # Only the files derived from this one: anything else that happens to
+        # share its stem in the upload folder is left alone.
+        for sidecar in (waveform.peaks_path(path), beats.beats_path(path), mp3index.index_path(path)):
+            try:
+                os.remove(sidecar)
+            except FileNotFoundError:
+                pass
+        renditions.cache_for(current_app.config).remove(renditions.cache_key(filename))
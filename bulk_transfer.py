@@ -0,0 +1,271 @@
+from flask import request, current_app, session, redirect, url_for, flash, abort, Response
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Preamble, Field, File, Data, Epilogue
+from werkzeug.wsgi import get_input_stream
+from sqlalchemy import insert
+from models import db, Team, TeamUpload
+from routes import team_member_required, allowed_file
+from byteserve import content_disposition
+from extensions import cache
+from datetime import datetime
+import blobstore
+import jobs
+import os
+import shutil
+import storage
+import tempfile
+import zipfile
+
+READ_SIZE = 256 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+MAX_BULK_SIZE = 2 * 1024 * 1024 * 1024
+MAX_BULK_FILES = 200
+MAX_ENTRY_SIZE = 200 * 1024 * 1024
+
+
+class _Part:
+    def __init__(self, reader, name, filename):
+        self.reader = reader
+        self.name = name
+        self.filename = filename
+        self.buffer = bytearray()
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            event = self.reader.next_event()
+            if not isinstance(event, Data):
+                raise ValueError('Malformed multipart body')
+            self.buffer += event.data
+            self.done = not event.more_data
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+
+class MultipartReader:
+    # Yields parts in the order the client sent them, each readable as a
+    # stream straight off the socket. Werkzeug's form parser would spool
+    # every file before the view runs and is capped by MAX_CONTENT_LENGTH.
+    def __init__(self, stream, boundary, max_parts=None):
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'), max_parts=max_parts)
+
+    def next_event(self):
+        while True:
+            event = self.decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            self.decoder.receive_data(self.stream.read(READ_SIZE) or None)
+
+    def __iter__(self):
+        part = None
+        while True:
+            if part is not None:
+                part.drain()
+            event = self.next_event()
+            if isinstance(event, Preamble):
+                continue
+            if isinstance(event, Epilogue):
+                return
+            if not isinstance(event, (Field, File)):
+                raise ValueError('Malformed multipart body')
+            part = _Part(self, event.name, event.filename if isinstance(event, File) else None)
+            yield part
+
+
+def _zip_entries(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or info.filename.startswith('__MACOSX/') or not allowed_file(name):
+                continue
+            if info.file_size > MAX_ENTRY_SIZE:
+                raise ValueError(f'{name} is too large')
+            with archive.open(info) as entry:
+                yield name, entry
+
+
+def _spool(part):
+    tmp_dir = os.path.join(blobstore.upload_root(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=tmp_dir, suffix='.zip')
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(part, f, READ_SIZE)
+    return path
+
+
+class _ZipSink:
+    # Write-only, so zipfile treats the output as unseekable: every entry
+    # gets a data descriptor after its bytes instead of a header rewrite.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _unique_name(name, seen):
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate.lower() in seen:
+        n += 1
+        candidate = f'{stem} ({n}){ext}'
+    seen.add(candidate.lower())
+    return candidate
+
+
+def _zip_chunks(backend, files, sink):
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for name, key, mtime in files:
+            try:
+                source, size = backend.open(key)
+            except FileNotFoundError:
+                continue
+            try:
+                info = zipfile.ZipInfo(name, date_time=mtime.timetuple()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                info.file_size = size
+                with archive.open(info, 'w') as dest:
+                    while True:
+                        chunk = source.read(READ_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        yield
+            finally:
+                source.close()
+            yield
+    yield
+
+
+def stream_zip(backend, files):
+    # files is a list of (archive name, storage key, mtime), read straight
+    # from the storage backend. MP3s do not compress, so entries are stored;
+    # memory use is one read buffer regardless of how large the folder is.
+    sink = _ZipSink()
+    for _ in _zip_chunks(backend, files, sink):
+        data = sink.take()
+        if data:
+            yield data
+
+
+def register_bulk_routes(app):
+    @app.route('/teams/<int:team_id>/upload/bulk', methods=['POST'])
+    @team_member_required
+    def team_bulk_upload(team_id):
+        mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            abort(400)
+        if request.content_length is None:
+            abort(411)
+        max_files = current_app.config.get('BULK_UPLOAD_MAX_FILES', MAX_BULK_FILES)
+        stream = get_input_stream(request.environ, max_content_length=current_app.config.get(
+            'BULK_UPLOAD_MAX_SIZE', MAX_BULK_SIZE))
+        folder = 'General'
+        spooled = []
+        skipped = []
+        try:
+            for part in MultipartReader(stream, options['boundary'], max_parts=max_files + 16):
+                if part.filename is None:
+                    if part.name == 'folder':
+                        folder = part.read(MAX_FIELD_SIZE).decode('utf-8', 'replace').strip() or 'General'
+                    continue
+                if not part.filename:
+                    continue
+                name = os.path.basename(part.filename.replace('\\', '/'))
+                if name.lower().endswith('.zip'):
+                    path = _spool(part)
+                    try:
+                        for entry_name, entry in _zip_entries(path):
+                            spooled.append((entry_name, blobstore.spool_stream(entry)))
+                            if len(spooled) > max_files:
+                                break
+                    finally:
+                        os.remove(path)
+                elif allowed_file(name):
+                    spooled.append((name, blobstore.spool_stream(part)))
+                else:
+                    skipped.append(name)
+                if len(spooled) > max_files:
+                    raise ValueError(f'At most {max_files} files can be uploaded at once')
+        except (ValueError, zipfile.BadZipFile) as e:
+            for _, spool in spooled:
+                blobstore.discard(spool)
+            flash(f'Upload failed: {e}', 'danger')
+            return redirect(url_for('team_upload', team_id=team_id))
+        except BaseException:
+            for _, spool in spooled:
+                blobstore.discard(spool)
+            raise
+
+        if not spooled:
+            flash('No MP3 files found in the upload.', 'danger')
+            return redirect(url_for('team_upload', team_id=team_id))
+
+        # Parts are only spooled while the body streams in; the blob
+        # refcounts and rows are written afterwards in one short
+        # transaction, so a long upload never holds the database write lock.
+        # The folder field may also arrive after the files.
+        stored = []
+        try:
+            for name, spool in spooled:
+                stored.append((name, blobstore.store_spooled(spool)))
+        except BaseException:
+            db.session.rollback()
+            blobstore.purge([blob.filename for _, blob in stored])
+            for _, spool in spooled:
+                blobstore.discard(spool)
+            raise
+        folder = folder[:100]
+        now = datetime.utcnow()
+        created = db.session.execute(insert(TeamUpload).returning(TeamUpload.id, TeamUpload.blob_id), [{
+            'team_id': team_id,
+            'user_id': session['user_id'],
+            'filename': blob.filename,
+            'original_filename': name[:256],
+            'folder': folder,
+            'uploaded_at': now,
+            'blob_id': blob.id,
+        } for name, blob in stored]).all()
+        for blob_id in sorted({blob.id for _, blob in stored}):
+            jobs.enqueue('process_blob', user_id=session['user_id'], blob_id=blob_id)
+        for upload_id, blob_id in created:
+            jobs.enqueue('analyse_team_upload', user_id=session['user_id'], blob_id=blob_id, upload_id=upload_id)
+        cache.invalidate(f'team-uploads:{team_id}')
+        db.session.commit()
+        message = f'Uploaded {len(stored)} file{"s" if len(stored) != 1 else ""} to {folder}.'
+        if skipped:
+            message += f' Skipped {len(skipped)} non-MP3 file{"s" if len(skipped) != 1 else ""}.'
+        flash(message, 'success')
+        return redirect(url_for('team_dashboard', team_id=team_id, folder=folder))
+
+    @app.route('/teams/<int:team_id>/folders/<path:folder>/download')
+    @team_member_required
+    def download_team_folder(team_id, folder):
+        team = Team.query.get_or_404(team_id)
+        uploads = TeamUpload.query.filter_by(team_id=team_id, folder=folder).order_by(
+            TeamUpload.original_filename, TeamUpload.id).all()
+        if not uploads:
+            abort(404)
+        seen = set()
+        files = [(_unique_name(upload.original_filename, seen), upload.filename, upload.uploaded_at)
+                 for upload in uploads]
+        return Response(stream_zip(storage.current(), files), mimetype='application/zip', headers={
+            'Cache-Control': 'private, no-store',
+            'Content-Disposition': content_disposition(f'{team.name} - {folder}.zip', True),
+        })
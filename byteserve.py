@@ -0,0 +1,217 @@
+from flask import request, current_app, Response
+from werkzeug.http import http_date, parse_date, dump_options_header
+from werkzeug.wsgi import wrap_file
+from urllib.parse import quote
+import os
+import secrets
+import unicodedata
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+DEFAULT_MAX_AGE = 365 * 24 * 3600
+OFFLOAD_MODES = ('', 'x-accel-redirect', 'x-sendfile')
+
+
+def file_etag(st):
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"
+
+
+def content_disposition(name, as_attachment):
+    # Same shape as send_file's header: dump_options_header quotes and
+    # escapes the name, and non-ASCII names get an RFC 5987 filename*.
+    kind = 'attachment' if as_attachment else 'inline'
+    name = ''.join(c for c in name or '' if unicodedata.category(c) != 'Cc')
+    if not name:
+        return kind
+    try:
+        name.encode('ascii')
+        names = {'filename': name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(name, safe='!#$&+^`|~')}"}
+    return dump_options_header(kind, names)
+
+
+def _resolve_ranges(header, length):
+    # Parsed here rather than with request.range: Werkzeug rejects overlapping
+    # or unordered sets, which RFC 9110 allows and players do send.
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+    spans = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                start, stop = max(length - int(last), 0), length
+            else:
+                start = int(first)
+                stop = length if not last else min(int(last) + 1, length)
+        except ValueError:
+            return None
+        if start < 0 or (last and first and int(last) < start):
+            return None
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and int(last_modified) <= since.timestamp()
+
+
+def _if_range_ok(etag, last_modified):
+    header = request.headers.get('If-Range')
+    if not header:
+        return True
+    if header.startswith('"') or header.startswith('W/'):
+        return header == f'"{etag}"'
+    when = parse_date(header)
+    return when is not None and int(last_modified) == int(when.timestamp())
+
+
+def _read_span(f, start, stop):
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = f.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _stream_spans(f, parts):
+    try:
+        for prefix, start, stop in parts:
+            yield prefix
+            if start is not None:
+                yield from _read_span(f, start, stop)
+    finally:
+        f.close()
+
+
+def _sendfile_body(f, start, stop, end_of_file):
+    # wsgi.file_wrapper lets gunicorn hand the descriptor to sendfile(2). It
+    # streams from the current offset, so only spans that run to the end of
+    # the blob can use it without depending on the server clipping the body.
+    if stop == end_of_file:
+        f.seek(start)
+        return wrap_file(request.environ, f, CHUNK_SIZE)
+    return _stream_spans(f, [(b'', start, stop)])
+
+
+def _offload(path, download_name, as_attachment, mimetype, max_age):
+    # The view has already authorized the request; the proxy in front streams
+    # the file and answers Range and conditional requests itself, so no
+    # worker is held for the length of the download.
+    mode = current_app.config.get('FILE_OFFLOAD')
+    root = os.path.realpath(current_app.config['UPLOAD_FOLDER'])
+    real_path = os.path.realpath(path)
+    if not mode or os.path.commonpath([root, real_path]) != root:
+        return None
+    os.stat(real_path)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'private, max-age={max_age}',
+        'Content-Disposition': content_disposition(download_name, as_attachment),
+    }
+    if mode == 'x-accel-redirect':
+        prefix = current_app.config.get('FILE_OFFLOAD_PREFIX', '/_protected/').rstrip('/')
+        headers['X-Accel-Redirect'] = f"{prefix}/{quote(os.path.relpath(real_path, root).replace(os.sep, '/'))}"
+    else:
+        headers['X-Sendfile'] = real_path
+    return Response(status=200, mimetype=mimetype, headers=headers)
+
+
+def send_audio(path, download_name=None, as_attachment=False, mimetype='audio/mpeg',
+               etag=None, span=None, max_age=None, offload=False):
+    if max_age is None:
+        max_age = current_app.config.get('AUDIO_CACHE_MAX_AGE', DEFAULT_MAX_AGE)
+    if offload and span is None:
+        response = _offload(path, download_name, as_attachment, mimetype, max_age)
+        if response is not None:
+            return response
+    f = open(path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        base, end = span if span else (0, st.st_size)
+        length = end - base
+        etag = etag or file_etag(st)
+        if span:
+            etag = f"{etag}-{base:x}-{end:x}"
+        last_modified = st.st_mtime
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{etag}"',
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': f'private, max-age={max_age}',
+            'Content-Disposition': content_disposition(download_name, as_attachment),
+        }
+
+        if _not_modified(etag, last_modified):
+            f.close()
+            return Response(status=304, headers=headers)
+
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header and _if_range_ok(etag, last_modified):
+            ranges = _resolve_ranges(range_header, length)
+            if ranges is not None and not ranges:
+                f.close()
+                headers['Content-Range'] = f'bytes */{length}'
+                return Response(status=416, headers=headers)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+
+        if not ranges or ranges == [(0, length)]:
+            body = _sendfile_body(f, base, end, st.st_size)
+            response = Response(body, status=200, mimetype=mimetype, headers=headers,
+                                direct_passthrough=True)
+            response.content_length = length
+            return response
+
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            body = _sendfile_body(f, base + start, base + stop, st.st_size)
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+            response = Response(body, status=206, mimetype=mimetype, headers=headers,
+                                direct_passthrough=True)
+            response.content_length = stop - start
+            return response
+
+        boundary = secrets.token_hex(16)
+        parts = []
+        total = 0
+        for start, stop in ranges:
+            prefix = (
+                f'\r\n--{boundary}\r\n'
+                f'Content-Type: {mimetype}\r\n'
+                f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n'
+            ).encode('ascii')
+            parts.append((prefix, base + start, base + stop))
+            total += len(prefix) + stop - start
+        closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        parts.append((closing, None, None))
+        total += len(closing)
+        response = Response(_stream_spans(f, parts), status=206, headers=headers,
+                            content_type=f'multipart/byteranges; boundary={boundary}',
+                            direct_passthrough=True)
+        response.content_length = total
+        return response
+    except Exception:
+        f.close()
+        raise
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from sqlalchemy import event
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+DEFAULT_LOCAL_SIZE = 4096
+DEFAULT_TTL = 300
+PURGE_EVERY = 1000
+MISSING = object()
+
+
+class LRUTier:
+    def __init__(self, maxsize=DEFAULT_LOCAL_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteTier:
+    # Shared by every worker process on the host. Each thread opens its own
+    # connection, and a forked worker never reuses its parent's.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS entry '
+                     '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS generation (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = self._connect()
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM entry WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return MISSING
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO entry (key, value, expires) VALUES (?, ?, ?)',
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl))
+        self.writes += 1
+        if self.writes % PURGE_EVERY == 0:
+            conn.execute('DELETE FROM entry WHERE expires <= ?', (time.time(),))
+
+    def generation(self, name):
+        row = self._conn().execute('SELECT value FROM generation WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        self._conn().execute('INSERT INTO generation (name, value) VALUES (?, 1) '
+                             'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+
+class Cache:
+    # A per-process LRU in front of an optional SQLite file shared by every
+    # worker. Nothing is deleted on invalidation: keys embed generation
+    # counters, invalidate() bumps them once the transaction commits, and
+    # stale entries stop being addressed and age out. Generations live in the
+    # shared tier when there is one and are read from it on every lookup (one
+    # primary-key SELECT), so a bump is seen by all workers at once.
+    def __init__(self):
+        self.local = None
+        self.shared = None
+        self.db = None
+        self.ttl = DEFAULT_TTL
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def init_app(self, app, db):
+        self.ttl = app.config.get('CACHE_TTL', DEFAULT_TTL)
+        self.local = LRUTier(app.config.get('CACHE_LOCAL_SIZE', DEFAULT_LOCAL_SIZE))
+        path = app.config.get('CACHE_SHARED_PATH')
+        self.shared = SQLiteTier(path) if path else None
+        app.extensions['cache'] = self
+        self.db = db
+        event.listen(db.session, 'after_commit', self._flush_invalidations)
+        event.listen(db.session, 'after_rollback', self._drop_invalidations)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not MISSING:
+            self.stats['local_hits'] += 1
+            return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.stats['shared_hits'] += 1
+                self.local.set(key, value, self.ttl)
+                return value
+        self.stats['misses'] += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def generation(self, name):
+        if self.shared is not None:
+            return self.shared.generation(name)
+        with self.lock:
+            return self.generations.get(name, 0)
+
+    def bump(self, name):
+        if self.shared is not None:
+            self.shared.bump(name)
+            return
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+
+    def invalidate(self, *names):
+        # Bumping before the commit would let a concurrent request cache the
+        # old rows under the new generation.
+        self.db.session.info.setdefault('cache_invalidate', set()).update(names)
+
+    def _flush_invalidations(self, session):
+        for name in session.info.pop('cache_invalidate', ()):
+            self.bump(name)
+
+    def _drop_invalidations(self, session):
+        session.info.pop('cache_invalidate', None)
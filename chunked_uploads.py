@@ -0,0 +1,208 @@
+from flask import request, jsonify, current_app, session, url_for, flash
+from models import db, AudioFile, TeamUpload, UploadSession
+from routes import login_required, allowed_file, is_team_member
+from extensions import cache
+from datetime import datetime, timedelta
+import blobstore
+import jobs
+import os
+import secrets
+import unicodedata
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024
+SESSION_TTL = timedelta(hours=24)
+COPY_BUFFER = 1024 * 1024
+
+
+def _part_path(upload_id):
+    return blobstore.absolute_path(os.path.join('tmp', f'{upload_id}.chunked'))
+
+
+def _status(upload):
+    return {
+        'id': upload.id,
+        'offset': upload.received,
+        'size': upload.total_size,
+        'chunk_size': CHUNK_SIZE,
+    }
+
+
+def _get_upload(upload_id):
+    return UploadSession.query.filter_by(id=upload_id, user_id=session['user_id']).first_or_404()
+
+
+def _discard(upload):
+    db.session.delete(upload)
+    db.session.commit()
+    try:
+        os.remove(_part_path(upload.id))
+    except FileNotFoundError:
+        pass
+
+
+def expire_stale(user_id=None):
+    # Called for the user on every new upload and for everyone from the job
+    # worker's periodic loop, so abandoned part files do not pile up.
+    cutoff = datetime.utcnow() - SESSION_TTL
+    query = UploadSession.query.filter(UploadSession.updated_at < cutoff)
+    if user_id is not None:
+        query = query.filter(UploadSession.user_id == user_id)
+    expired = query.all()
+    for upload in expired:
+        _discard(upload)
+    return len(expired)
+
+
+def _clean(value, limit):
+    # Names end up in Content-Disposition headers and ZIP entries.
+    value = ''.join(c for c in str(value) if unicodedata.category(c)[0] != 'C')
+    return value.strip()[:limit]
+
+
+def _parse_content_range(header, total_size):
+    units, _, spec = (header or '').partition(' ')
+    span, _, total = spec.partition('/')
+    first, _, last = span.partition('-')
+    try:
+        start, end = int(first), int(last) + 1
+    except ValueError:
+        return None
+    if units != 'bytes' or total not in ('*', str(total_size)) or not 0 <= start < end <= total_size:
+        return None
+    return start, end
+
+
+def register_upload_routes(app):
+    @app.route('/uploads', methods=['POST'])
+    @login_required
+    def initiate_upload():
+        data = request.get_json(silent=True) if request.is_json else request.form
+        if not isinstance(data, dict):
+            return jsonify(error='Expected a JSON object.'), 400
+        filename = _clean(data.get('filename') or '', 256)
+        team_id = data.get('team_id') or None
+        folder = _clean(data.get('folder') or '', 100) or 'General'
+        try:
+            size = int(data.get('size'))
+            team_id = int(team_id) if team_id is not None else None
+        except (TypeError, ValueError):
+            return jsonify(error='Invalid upload size or team.'), 400
+        if not allowed_file(filename):
+            return jsonify(error='Only MP3 files are allowed.'), 400
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            return jsonify(error='Invalid upload size.'), 400
+        if team_id is not None:
+            if not is_team_member(team_id, session['user_id']):
+                return jsonify(error='You are not a member of this team.'), 403
+        expire_stale(session['user_id'])
+        upload = UploadSession(
+            id=secrets.token_hex(16),
+            user_id=session['user_id'],
+            team_id=team_id,
+            folder=folder if team_id is not None else None,
+            original_filename=filename,
+            total_size=size
+        )
+        os.makedirs(os.path.dirname(_part_path(upload.id)), exist_ok=True)
+        open(_part_path(upload.id), 'wb').close()
+        db.session.add(upload)
+        db.session.commit()
+        return jsonify(_status(upload)), 201
+
+    @app.route('/uploads/<upload_id>', methods=['GET'])
+    @login_required
+    def upload_status(upload_id):
+        return jsonify(_status(_get_upload(upload_id)))
+
+    @app.route('/uploads/<upload_id>', methods=['PUT'])
+    @login_required
+    def upload_chunk(upload_id):
+        upload = _get_upload(upload_id)
+        span = _parse_content_range(request.headers.get('Content-Range'), upload.total_size)
+        if span is None:
+            return jsonify(error='Missing or invalid Content-Range.', **_status(upload)), 400
+        start, end = span
+        if start > upload.received:
+            return jsonify(error='Chunk does not continue the upload.', **_status(upload)), 409
+        if request.content_length != end - start:
+            return jsonify(error='Content-Length does not match Content-Range.', **_status(upload)), 400
+        written = 0
+        with open(_part_path(upload.id), 'r+b') as f:
+            f.seek(start)
+            while written < end - start:
+                chunk = request.stream.read(min(COPY_BUFFER, end - start - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+        if written != end - start:
+            return jsonify(error='Chunk was truncated.', **_status(upload)), 400
+        UploadSession.query.filter(UploadSession.id == upload.id, UploadSession.received < end).update(
+            {UploadSession.received: end, UploadSession.updated_at: datetime.utcnow()},
+            synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(upload)
+        return jsonify(_status(upload))
+
+    @app.route('/uploads/<upload_id>', methods=['DELETE'])
+    @login_required
+    def abort_upload(upload_id):
+        _discard(_get_upload(upload_id))
+        return '', 204
+
+    @app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+    @login_required
+    def finalize_upload(upload_id):
+        upload = _get_upload(upload_id)
+        part_path = _part_path(upload.id)
+        if upload.received != upload.total_size or not os.path.exists(part_path):
+            return jsonify(error='Upload is incomplete.', **_status(upload)), 409
+        if upload.team_id is not None and not is_team_member(upload.team_id, upload.user_id):
+            return jsonify(error='You are not a member of this team.'), 403
+        # Claim the session before touching the part file: of two concurrent
+        # finalize calls only one deletes the row, the other gets a 409.
+        fields = {column.name: getattr(upload, column.name) for column in UploadSession.__table__.columns}
+        db.session.expunge(upload)
+        claimed = UploadSession.query.filter_by(id=upload.id, received=upload.total_size).delete(
+            synchronize_session=False)
+        db.session.commit()
+        if claimed != 1:
+            return jsonify(error='Upload is already being finalized.'), 409
+        upload = UploadSession(**fields)
+        try:
+            with open(part_path, 'rb+') as f:
+                os.fsync(f.fileno())
+            blob = blobstore.store_file(part_path)
+        except BaseException:
+            # The part file is still there, so the client can retry.
+            db.session.rollback()
+            if os.path.exists(part_path):
+                db.session.add(upload)
+                db.session.commit()
+            raise
+        if upload.team_id is not None:
+            row = TeamUpload(
+                team_id=upload.team_id,
+                user_id=upload.user_id,
+                filename=blob.filename,
+                original_filename=upload.original_filename,
+                folder=upload.folder,
+                blob_id=blob.id
+            )
+            redirect_url = url_for('team_dashboard', team_id=upload.team_id)
+        else:
+            row = AudioFile(user_id=upload.user_id, filename=blob.filename,
+                            original_filename=upload.original_filename, blob_id=blob.id)
+            redirect_url = url_for('dashboard')
+        db.session.add(row)
+        jobs.enqueue('process_blob', user_id=upload.user_id, blob_id=blob.id)
+        if upload.team_id is not None:
+            jobs.enqueue('analyse_team_upload', user_id=upload.user_id, blob_id=blob.id, upload_id=row.id)
+            cache.invalidate(f'team-uploads:{upload.team_id}')
+        else:
+            jobs.enqueue('analyse_audio', user_id=upload.user_id, audio_id=row.id)
+        db.session.commit()
+        current_app.logger.info('Finalized chunked upload %s (%s bytes)', upload_id, blob.size)
+        flash('File uploaded successfully!', 'success')
+        return jsonify(id=row.id, redirect=redirect_url), 201
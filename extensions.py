@@ -1,7 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
+from cache import Cache
+from instrumentation import Instrumentation
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
-jwt = JWTManager() 
\ No newline at end of file
+jwt = JWTManager() 
+cache = Cache()
+instrumentation = Instrumentation()
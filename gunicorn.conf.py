@@ -0,0 +1,64 @@
+# Production serving settings, read by `gunicorn -c gunicorn.conf.py wsgi:app`.
+#
+# Streaming a song to a slow phone keeps a connection open for minutes, so
+# a sync worker per connection lets a handful of listeners starve logins.
+# Both worker classes here keep many connections per process:
+#
+#   WEB_WORKER_CLASS=gthread  threads per worker (default, no extra deps)
+#   WEB_WORKER_CLASS=gevent   greenlets per worker (pip install gevent)
+#
+# With FILE_OFFLOAD set, downloads are handed to the proxy in front and
+# workers are only held for the authorization check.
+import glob
+import os
+import shutil
+import tempfile
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+if worker_class not in ('gthread', 'gevent'):
+    raise RuntimeError('WEB_WORKER_CLASS must be gthread or gevent')
+
+if worker_class == 'gevent':
+    # Patch before the app is preloaded so the locks, thread-locals and
+    # sockets it creates are the cooperative ones.
+    from gevent import monkey
+    monkey.patch_all()
+
+cpus = os.cpu_count() or 1
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# Decoding, analysis and bcrypt hold the GIL, so processes rather than
+# threads are what add CPU; threads or greenlets only cover waiting on
+# slow clients and disk.
+workers = int(os.environ.get('WEB_CONCURRENCY', cpus + 1))
+threads = int(os.environ.get('WEB_THREADS', 16))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 500))
+
+# Import the app once in the master: create_app() creates the schema, the
+# secret keys and the cache tables a single time, workers fork with the code
+# already loaded, and a broken deploy fails before any worker starts.
+preload_app = os.environ.get('WEB_PRELOAD', '1') == '1'
+
+# Slow uploads over mobile connections need longer than the 30 s default;
+# keepalive lets the player's Range requests reuse one connection.
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 15))
+
+accesslog = None
+errorlog = '-'
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1')
+
+# Workers share metric snapshots through this directory. Snapshots left by
+# a previous run are cleared so their counters are not merged into this one.
+metrics_dir = os.environ.get('METRICS_DIR')
+owns_metrics_dir = not metrics_dir
+if owns_metrics_dir:
+    metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='ddm-metrics-')
+os.makedirs(metrics_dir, exist_ok=True)
+for snapshot in glob.glob(os.path.join(metrics_dir, '*.json')):
+    os.remove(snapshot)
+
+
+def on_exit(server):
+    if owns_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,344 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import Response, abort, g, has_request_context, request, session
+from metrics import COUNT_BUCKETS, Registry, render
+from profiling import SamplingProfiler
+from sqlalchemy import event
+import ipaddress
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+ENVIRON_KEY = 'ddm.instrumentation'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+STATEMENT_LOG_LIMIT = 500
+RESERVED_LOG_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; anything passed through extra= becomes a
+    # top-level field.
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_LOG_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.user_id = session.get('user_id')
+        return True
+
+
+class RequestState:
+    __slots__ = ('request_id', 'queries', 'sql_seconds', 'statements', 'profiler')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = {}
+        self.profiler = None
+
+
+class StorageOperation:
+    __slots__ = ('bytes',)
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class _MeteredBody:
+    # Counts bytes as the server pulls them, so the duration covers the
+    # whole transfer rather than just building the response.
+    def __init__(self, iterable, finish):
+        self.iterable = iterable
+        self.finish = finish
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.finish(self.sent)
+
+
+_file_wrappers = {}
+
+
+def _metered_file_wrapper(base):
+    # The server only hands a body to sendfile() when it is an instance of
+    # the wsgi.file_wrapper it supplied, so wrapping it like any other body
+    # would silently turn sendfile off. A subclass keeps it and still hears
+    # about the end of the transfer through close().
+    wrapper = _file_wrappers.get(base)
+    if wrapper is None:
+        class MeteredFileWrapper(base):
+            finish = None
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # gunicorn's wrapper binds the file's close() on the instance,
+                # which would shadow the method below.
+                self.close_file = self.__dict__.pop('close', None)
+
+            def close(self):
+                try:
+                    if self.close_file is not None:
+                        self.close_file()
+                    elif hasattr(super(), 'close'):
+                        super().close()
+                finally:
+                    finish, self.finish = self.finish, None
+                    if finish is not None:
+                        finish(None)
+
+        wrapper = _file_wrappers[base] = MeteredFileWrapper
+    return wrapper
+
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+
+class Instrumentation:
+    def __init__(self):
+        self.registry = None
+        self.logger = None
+        self.slow_query_seconds = 0.25
+        self.n_plus_one_threshold = 10
+        self.profile_token = None
+        self.profile_dir = None
+        self.profile_interval = 0.005
+        self.metrics_token = None
+        self.access_log = True
+
+    def init_app(self, app, db):
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS', self.slow_query_seconds)
+        self.n_plus_one_threshold = app.config.get('N_PLUS_ONE_THRESHOLD', self.n_plus_one_threshold)
+        self.profile_token = app.config.get('PROFILE_TOKEN')
+        self.profile_dir = app.config.get('PROFILE_DIR')
+        self.profile_interval = app.config.get('PROFILE_INTERVAL', self.profile_interval)
+        self.metrics_token = app.config.get('METRICS_TOKEN')
+        self.access_log = app.config.get('ACCESS_LOG', True)
+        self.logger = app.logger
+        self._configure_logging(app)
+
+        directory = app.config.get('METRICS_DIR')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        registry = self.registry = Registry(directory)
+        self.requests = registry.counter(
+            'ddm_http_requests_total', 'Requests handled.', ('endpoint', 'method', 'status'))
+        self.request_seconds = registry.histogram(
+            'ddm_http_request_duration_seconds', 'Time to build the response.', ('endpoint', 'method'))
+        self.transfer_seconds = registry.histogram(
+            'ddm_http_transfer_duration_seconds', 'Time until the last response byte was handed to the server.',
+            ('endpoint',))
+        self.request_bytes = registry.counter(
+            'ddm_http_request_body_bytes_total', 'Request body bytes received.', ('endpoint',))
+        self.response_bytes = registry.counter(
+            'ddm_http_response_body_bytes_total', 'Response body bytes sent.', ('endpoint',))
+        self.queries = registry.histogram(
+            'ddm_db_query_duration_seconds', 'SQL statement execution time.', ('endpoint',))
+        self.queries_per_request = registry.histogram(
+            'ddm_db_queries_per_request', 'SQL statements executed per request.', ('endpoint',), COUNT_BUCKETS)
+        self.slow_queries = registry.counter(
+            'ddm_db_slow_queries_total', 'SQL statements slower than SLOW_QUERY_SECONDS.', ('endpoint',))
+        self.n_plus_one = registry.counter(
+            'ddm_db_repeated_queries_total',
+            'Requests that ran one SELECT at least N_PLUS_ONE_THRESHOLD times.', ('endpoint',))
+        self.storage_seconds = registry.histogram(
+            'ddm_storage_duration_seconds', 'Blob storage operation time.', ('operation',))
+        self.storage_bytes = registry.counter(
+            'ddm_storage_bytes_total', 'Blob storage bytes moved.', ('operation',))
+        registry.collector(
+            'ddm_cache_lookups_total', 'Cache lookups by outcome.', ('result',),
+            lambda: self._cache_stats(app))
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(db.engine, 'handle_error', self._handle_error)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.wsgi_app = self._middleware(app.wsgi_app)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        app.extensions['instrumentation'] = self
+
+    def _configure_logging(self, app):
+        if app.config.get('LOG_FORMAT', 'json') == 'json':
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter())
+            app.logger.handlers[:] = [handler]
+            app.logger.propagate = False
+        for handler in app.logger.handlers:
+            handler.addFilter(RequestContextFilter())
+        app.logger.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+
+    @staticmethod
+    def _cache_stats(app):
+        cache = app.extensions.get('cache')
+        if cache is None:
+            return {}
+        return {('local_hit',): cache.stats['local_hits'], ('shared_hit',): cache.stats['shared_hits'],
+                ('miss',): cache.stats['misses']}
+
+    @staticmethod
+    def _endpoint(environ):
+        return environ.get(ENVIRON_KEY + '.endpoint') or 'unmatched'
+
+    def _middleware(self, wsgi_app):
+        def middleware(environ, start_response):
+            started = time.perf_counter()
+            environ[ENVIRON_KEY + '.started'] = started
+            content_length = []
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                environ['wsgi.file_wrapper'] = metered = _metered_file_wrapper(file_wrapper)
+            else:
+                metered = None
+
+            def metered_start_response(status, headers, exc_info=None):
+                for name, value in headers:
+                    if name.lower() == 'content-length':
+                        content_length.append(int(value))
+                return start_response(status, headers, exc_info)
+
+            def finish(sent):
+                endpoint = self._endpoint(environ)
+                if sent is None:
+                    sent = content_length[0] if content_length else 0
+                self.transfer_seconds.observe((endpoint,), time.perf_counter() - started)
+                self.response_bytes.inc((endpoint,), sent)
+                self.registry.maybe_write()
+
+            body = wsgi_app(environ, metered_start_response)
+            if metered is not None and isinstance(body, metered):
+                body.finish = finish
+                return body
+            return _MeteredBody(body, finish)
+
+        return middleware
+
+    def _before_request(self):
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        g.request_id = request_id
+        state = g.instrumentation = RequestState(request_id)
+        if self.profile_token and request.headers.get('X-Profile') == self.profile_token:
+            state.profiler = SamplingProfiler(threading.get_ident(), self.profile_interval).start()
+
+    def _after_request(self, response):
+        state = g.get('instrumentation')
+        if state is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        request.environ[ENVIRON_KEY + '.endpoint'] = endpoint
+        started = request.environ.get(ENVIRON_KEY + '.started', time.perf_counter())
+        elapsed = time.perf_counter() - started
+        self.requests.inc((endpoint, request.method, str(response.status_code)))
+        self.request_seconds.observe((endpoint, request.method), elapsed)
+        self.queries_per_request.observe((endpoint,), state.queries)
+        if request.content_length:
+            self.request_bytes.inc((endpoint,), request.content_length)
+
+        for statement, count in state.statements.items():
+            if count >= self.n_plus_one_threshold and statement.lstrip().upper().startswith('SELECT'):
+                self.n_plus_one.inc((endpoint,))
+                self.logger.warning('Repeated query', extra={
+                    'endpoint': endpoint, 'count': count, 'statement': statement[:STATEMENT_LOG_LIMIT]})
+
+        if state.profiler is not None:
+            profiler = state.profiler.stop()
+            path = os.path.join(self.profile_dir, f'{state.request_id}.folded')
+            profiler.write(path)
+            response.headers['X-Profile-Samples'] = str(profiler.samples)
+            self.logger.info('Profiled request', extra={
+                'endpoint': endpoint, 'samples': profiler.samples, 'profile': path})
+
+        response.headers['X-Request-ID'] = state.request_id
+        if self.access_log:
+            self.logger.info('%s %s %s %.1fms', request.method, request.path, response.status_code,
+                             elapsed * 1000, extra={
+                                 'method': request.method, 'path': request.path, 'endpoint': endpoint,
+                                 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 2),
+                                 'queries': state.queries, 'sql_ms': round(state.sql_seconds * 1000, 2),
+                                 'request_bytes': request.content_length or 0,
+                                 'response_bytes': response.content_length})
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        # Only request-scoped statements are counted: background ones never
+        # reach a scrape, and a preloading master would hand its counts to
+        # every worker it forks.
+        in_request = has_request_context()
+        endpoint = (request.endpoint or 'unmatched') if in_request else 'background'
+        if in_request:
+            self.queries.observe((endpoint,), elapsed)
+        if elapsed >= self.slow_query_seconds:
+            self.slow_queries.inc((endpoint,))
+            self.logger.warning('Slow query', extra={
+                'endpoint': endpoint, 'duration_ms': round(elapsed * 1000, 2),
+                'statement': statement[:STATEMENT_LOG_LIMIT]})
+        state = g.get('instrumentation') if in_request else None
+        if state is not None:
+            state.queries += 1
+            state.sql_seconds += elapsed
+            state.statements[statement] = state.statements.get(statement, 0) + 1
+
+    def _handle_error(self, context):
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+
+    @contextmanager
+    def storage(self, operation):
+        # Times a blob store operation; the caller sets .bytes when known.
+        started = time.perf_counter()
+        op = StorageOperation()
+        try:
+            yield op
+        finally:
+            if self.registry is not None:
+                self.storage_seconds.observe((operation,), time.perf_counter() - started)
+                self.storage_bytes.inc((operation,), op.bytes)
+
+    def _metrics_view(self):
+        # Without a token only a scraper on this host gets the metrics; a
+        # request relayed by a local reverse proxy carries X-Forwarded-For.
+        if self.metrics_token:
+            if request.headers.get('Authorization') != f'Bearer {self.metrics_token}':
+                abort(403)
+        elif not _is_loopback(request.remote_addr) or 'X-Forwarded-For' in request.headers:
+            abort(404)
+        self.registry.maybe_write()
+        return Response(render(self.registry.collect()), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,131 @@
+from flask import current_app
+from models import db, Job
+from datetime import datetime, timedelta
+import json
+import random
+import traceback
+
+HANDLERS = {}
+ACTIVE = ('queued', 'running')
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+
+
+def task(kind):
+    def register(f):
+        HANDLERS[kind] = f
+        return f
+    return register
+
+
+def enqueue(kind, user_id=None, blob_id=None, max_attempts=5, **payload):
+    if blob_id is not None:
+        payload['blob_id'] = blob_id
+    job = Job(kind=kind, payload=json.dumps(payload), user_id=user_id, blob_id=blob_id,
+              audio_id=payload.get('audio_id'), max_attempts=max_attempts, run_after=datetime.utcnow())
+    db.session.add(job)
+    db.session.flush()
+    if current_app.config.get('JOBS_EAGER'):
+        job.attempts = 1
+        HANDLERS[kind](**payload)
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+    return job
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def claim(worker_id, limit):
+    now = datetime.utcnow()
+    candidates = db.session.query(Job.id).filter(
+        Job.status == 'queued', Job.run_after <= now).order_by(Job.id).limit(limit * 2).all()
+    claimed = []
+    for (job_id,) in candidates:
+        if len(claimed) >= limit:
+            break
+        updated = Job.query.filter_by(id=job_id, status='queued').update({
+            Job.status: 'running',
+            Job.locked_by: worker_id,
+            Job.heartbeat_at: now,
+            Job.attempts: Job.attempts + 1,
+        }, synchronize_session=False)
+        db.session.commit()
+        if updated:
+            claimed.append(job_id)
+    return claimed
+
+
+def heartbeat(job_ids):
+    if job_ids:
+        Job.query.filter(Job.id.in_(job_ids), Job.status == 'running').update(
+            {Job.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+
+def recover_stale(stale_after):
+    # A job that takes its worker down with it is claimed, and its attempt
+    # counted, every time it is retried; once out of attempts it fails.
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=stale_after)
+    stale = (Job.status == 'running', Job.heartbeat_at < cutoff)
+    failed = Job.query.filter(*stale, Job.attempts >= Job.max_attempts).update({
+        Job.status: 'failed',
+        Job.locked_by: None,
+        Job.finished_at: now,
+        Job.last_error: 'worker stopped sending heartbeats',
+    }, synchronize_session=False)
+    recovered = Job.query.filter(*stale).update({
+        Job.status: 'queued',
+        Job.locked_by: None,
+        Job.last_error: 'worker stopped sending heartbeats',
+    }, synchronize_session=False)
+    db.session.commit()
+    if failed:
+        current_app.logger.error('Failed %s jobs that exhausted their attempts on crashed workers', failed)
+    return recovered
+
+
+def finish(job_id, error=None):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return
+    if error is None:
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        job.last_error = None
+    elif job.attempts < job.max_attempts:
+        job.status = 'queued'
+        job.run_after = datetime.utcnow() + backoff(job.attempts)
+        job.last_error = error
+    else:
+        job.status = 'failed'
+        job.finished_at = datetime.utcnow()
+        job.last_error = error
+    job.locked_by = None
+    db.session.commit()
+
+
+def run(job_id):
+    job = db.session.get(Job, job_id)
+    try:
+        HANDLERS[job.kind](**json.loads(job.payload))
+        db.session.commit()
+        return None
+    except Exception:
+        db.session.rollback()
+        return traceback.format_exc()
+
+
+def describe(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.last_error.strip().splitlines()[-1] if job.last_error else None,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
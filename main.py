@@ -1,29 +1,88 @@
 from flask import Flask
 from routes import register_routes
-from extensions import db, jwt
+from chunked_uploads import register_upload_routes
+from api import register_api_routes
+from bulk_transfer import register_bulk_routes
+from search import register_search_routes
+from extensions import db, jwt, cache, instrumentation
+from startup import init_database, persistent_secret
+from byteserve import OFFLOAD_MODES
+import search
+import storage
+import tasks
 import os
-import secrets
 
 def create_app():
     app = Flask(__name__)
     
-    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
-    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', secrets.token_hex(32))
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or persistent_secret(
+        os.environ.get('SECRET_KEY_FILE', os.path.join(app.instance_path, 'secret_key')))
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY') or persistent_secret(
+        os.environ.get('JWT_SECRET_KEY_FILE', os.path.join(app.instance_path, 'jwt_secret_key')))
+    app.config['STARTUP_LOCK_PATH'] = os.path.join(app.instance_path, 'startup.lock')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///ddm.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
     app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+    app.config['BULK_UPLOAD_MAX_SIZE'] = int(os.environ.get('BULK_UPLOAD_MAX_SIZE', 2 * 1024 ** 3))
+    app.config['BULK_UPLOAD_MAX_FILES'] = int(os.environ.get('BULK_UPLOAD_MAX_FILES', 200))
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+    app.config['STORAGE_S3_BUCKET'] = os.environ.get('STORAGE_S3_BUCKET')
+    app.config['STORAGE_S3_PREFIX'] = os.environ.get('STORAGE_S3_PREFIX', '')
+    app.config['STORAGE_S3_ENDPOINT_URL'] = os.environ.get('STORAGE_S3_ENDPOINT_URL')
+    app.config['STORAGE_S3_PUBLIC_ENDPOINT_URL'] = os.environ.get('STORAGE_S3_PUBLIC_ENDPOINT_URL')
+    app.config['STORAGE_S3_REGION'] = os.environ.get('STORAGE_S3_REGION')
+    app.config['STORAGE_REDIRECTS'] = os.environ.get('STORAGE_REDIRECTS', '1') == '1'
+    app.config['STORAGE_PRESIGN_EXPIRES'] = int(os.environ.get('STORAGE_PRESIGN_EXPIRES', 3600))
+    app.config['FILE_OFFLOAD'] = os.environ.get('FILE_OFFLOAD', '')
+    app.config['FILE_OFFLOAD_PREFIX'] = os.environ.get('FILE_OFFLOAD_PREFIX', '/_protected/')
+    if app.config['FILE_OFFLOAD'] not in OFFLOAD_MODES:
+        raise ValueError(f"FILE_OFFLOAD must be one of {', '.join(filter(None, OFFLOAD_MODES))}")
+    app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 50))
+
+    app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '0') == '1'
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+    app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+    app.config['JOB_STALE_AFTER'] = int(os.environ.get('JOB_STALE_AFTER', 300))
     
+    app.config['RENDITION_CACHE_DIR'] = os.environ.get(
+        'RENDITION_CACHE_DIR', os.path.join(app.config['UPLOAD_FOLDER'], 'renditions'))
+    app.config['RENDITION_CACHE_BYTES'] = int(os.environ.get('RENDITION_CACHE_BYTES', 2 * 1024 ** 3))
+
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    app.config['CACHE_LOCAL_SIZE'] = int(os.environ.get('CACHE_LOCAL_SIZE', 4096))
+    app.config['CACHE_SHARED_PATH'] = os.environ.get(
+        'CACHE_SHARED_PATH', os.path.join(app.instance_path, 'cache.sqlite3'))
+
+    app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+    app.config['ACCESS_LOG'] = os.environ.get('ACCESS_LOG', '1') == '1'
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['SLOW_QUERY_SECONDS'] = float(os.environ.get('SLOW_QUERY_SECONDS', 0.25))
+    app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+    app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+    app.config['PROFILE_DIR'] = os.environ.get(
+        'PROFILE_DIR', os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'))
+    app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
     db.init_app(app)
     jwt.init_app(app)
+    cache.init_app(app, db)
+    instrumentation.init_app(app, db)
+    storage.init_app(app)
+    search.init_app(app, db)
     
     register_routes(app)
+    register_upload_routes(app)
+    register_api_routes(app)
+    register_bulk_routes(app)
+    register_search_routes(app)
     
-    with app.app_context():
-        db.create_all()
+    init_database(app, db)
     
     return app
 
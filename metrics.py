@@ -0,0 +1,184 @@
+from bisect import bisect_left
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SNAPSHOT_INTERVAL = 1.0
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return {json.dumps(labels): value for labels, value in self.values.items()}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        # Per-bucket counts plus sum and count; made cumulative on render.
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {json.dumps(labels): list(state) for labels, state in self.values.items()}
+
+
+class Registry:
+    # Metrics are per process. With METRICS_DIR set every process also
+    # writes its snapshot there, and /metrics sums all of them, so a scrape
+    # that lands on any gunicorn worker sees the whole server.
+    def __init__(self, directory=None):
+        self.metrics = []
+        self.collectors = []
+        self.directory = directory
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, name, documentation, labelnames, collect):
+        # collect() returns {labels: value} for counters read at snapshot time.
+        self.collectors.append((name, documentation, labelnames, collect))
+
+    def snapshot(self):
+        families = {}
+        for metric in self.metrics:
+            families[metric.name] = {
+                'type': metric.kind,
+                'help': metric.documentation,
+                'labels': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.snapshot(),
+            }
+        for name, documentation, labelnames, collect in self.collectors:
+            families[name] = {
+                'type': 'counter',
+                'help': documentation,
+                'labels': list(labelnames),
+                'buckets': [],
+                'samples': {json.dumps(labels): value for labels, value in collect().items()},
+            }
+        return families
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, f'{os.getpid()}.json')
+
+    def maybe_write(self):
+        if not self.directory or time.monotonic() - self.last_write < SNAPSHOT_INTERVAL:
+            return
+        with self.lock:
+            if time.monotonic() - self.last_write < SNAPSHOT_INTERVAL:
+                return
+            self.last_write = time.monotonic()
+        path = self._snapshot_path()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge(snapshots)
+
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.setdefault(name, dict(family, samples={}))
+            for key, value in family['samples'].items():
+                if key not in target['samples']:
+                    target['samples'][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(target['samples'][key], value)]
+                else:
+                    target['samples'][key] += value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(families):
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for key in sorted(family['samples']):
+            values = json.loads(key)
+            sample = family['samples'][key]
+            if family['type'] != 'histogram':
+                lines.append(f"{name}{_labels(family['labels'], values)} {_number(sample)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + [math.inf], sample):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(family['labels'], values, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(family['labels'], values)} {_number(sample[-2])}")
+            lines.append(f"{name}_count{_labels(family['labels'], values)} {sample[-1]}")
+    return '\n'.join(lines) + '\n'
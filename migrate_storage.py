@@ -0,0 +1,87 @@
+"""Copy stored audio from one storage backend to another.
+
+    STORAGE_S3_BUCKET=ddm python migrate_storage.py --from local --to s3
+    python migrate_storage.py --from s3 --to local --workers 32 --dry-run
+
+Both backends are configured from the same environment as the app. Keys
+come from the database (every blob, plus files uploaded before blobs
+existed), so sidecars, caches and temp files are never copied. Objects
+already present in the target with the right size are skipped, so an
+interrupted run can simply be started again. Switch STORAGE_BACKEND once
+a run reports no failures.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from main import create_app
+from models import db, Blob, AudioFile, TeamUpload
+from storage import BACKENDS, create_storage
+import argparse
+import sys
+import time
+
+
+def stored_keys():
+    keys = {blob.filename for blob in Blob.query.all()}
+    for model in (AudioFile, TeamUpload):
+        keys.update(filename for (filename,) in db.session.query(model.filename).filter(model.blob_id.is_(None)))
+    return sorted(keys)
+
+
+def copy_key(source, target, key, dry_run):
+    size = source.size(key)
+    if size is None:
+        return 'missing', 0
+    if target.size(key) == size:
+        return 'skipped', 0
+    if dry_run:
+        return 'copied', size
+    body, size = source.open(key)
+    try:
+        target.put_stream(key, body)
+    finally:
+        body.close()
+    if target.size(key) != size:
+        raise RuntimeError(f'size mismatch after copying {key}')
+    return 'copied', size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='source', choices=BACKENDS, required=True)
+    parser.add_argument('--to', dest='target', choices=BACKENDS, required=True)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--dry-run', action='store_true', help='report what would be copied')
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error('--from and --to must differ')
+
+    app = create_app()
+    with app.app_context():
+        keys = stored_keys()
+    source = create_storage(app.config, args.source)
+    target = create_storage(app.config, args.target)
+
+    started = time.monotonic()
+    counts = {'copied': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+    copied_bytes = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(copy_key, source, target, key, args.dry_run): key for key in keys}
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                outcome, size = future.result()
+            except Exception as e:
+                outcome, size = 'failed', 0
+                print(f'failed {key}: {e}', file=sys.stderr)
+            if outcome == 'missing':
+                print(f'missing {key}', file=sys.stderr)
+            counts[outcome] += 1
+            copied_bytes += size
+            if done % 100 == 0 or done == len(keys):
+                elapsed = time.monotonic() - started
+                print(f'{done}/{len(keys)} keys, {copied_bytes / 1e6:.1f} MB in {elapsed:.1f}s')
+    print(('dry run: ' if args.dry_run else '') + ', '.join(f'{name}={count}' for name, count in counts.items()))
+    sys.exit(1 if counts['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,10 @@ class Team(db.Model):
         super().__init__(**kwargs)
 
 class TeamMember(db.Model):
+    __table_args__ = (
+        db.Index('ix_team_member_team_user', 'team_id', 'user_id'),
+        db.Index('ix_team_member_user_joined', 'user_id', 'joined_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -32,6 +36,10 @@ class TeamMember(db.Model):
         super().__init__(**kwargs)
 
 class TeamUpload(db.Model):
+    __table_args__ = (
+        db.Index('ix_team_upload_team_uploaded', 'team_id', 'uploaded_at', 'id'),
+        db.Index('ix_team_upload_team_folder_uploaded', 'team_id', 'folder', 'uploaded_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -39,16 +47,36 @@ class TeamUpload(db.Model):
     original_filename = db.Column(db.String(256), nullable=False)
     folder = db.Column(db.String(100), default='General')
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
+    tempo = db.Column(db.Float)
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+class Blob(db.Model):
+    __tablename__ = 'blob'
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+    @property
+    def filename(self):
+        return f"blobs/{self.digest[:2]}/{self.digest}.mp3"
+
 class AudioFile(db.Model):
     __tablename__ = 'audiofile'
+    __table_args__ = (db.Index('ix_audiofile_user_upload_date', 'user_id', 'upload_date', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     filename = db.Column(db.String(256), nullable=False)
     original_filename = db.Column(db.String(256), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
+    duration = db.Column(db.Float)
+    tempo = db.Column(db.Float)
+    revision = db.Column(db.Integer, nullable=False, default=0)
     loops = db.relationship('Loop', backref='audiofile', lazy=True)
     notes = db.relationship('Note', backref='audiofile', lazy=True)
     settings = db.relationship('AudioSetting', backref='audiofile', lazy=True, uselist=False)
@@ -58,17 +86,18 @@ class AudioFile(db.Model):
 class Loop(db.Model):
     __tablename__ = 'loop'
     id = db.Column(db.Integer, primary_key=True)
-    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False)
+    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False, index=True)
     start_time = db.Column(db.Float, nullable=False)
     end_time = db.Column(db.Float, nullable=False)
     label = db.Column(db.String(128))
+    auto = db.Column(db.Boolean, nullable=False, default=False)
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
 class Note(db.Model):
     __tablename__ = 'note'
     id = db.Column(db.Integer, primary_key=True)
-    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False)
+    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False, index=True)
     timestamp = db.Column(db.Float, nullable=False)
     text = db.Column(db.String(512))
     def __init__(self, **kwargs):
@@ -77,7 +106,42 @@ class Note(db.Model):
 class AudioSetting(db.Model):
     __tablename__ = 'audiosetting'
     id = db.Column(db.Integer, primary_key=True)
-    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False)
+    audiofile_id = db.Column(db.Integer, db.ForeignKey('audiofile.id'), nullable=False, index=True)
     speed = db.Column(db.Float, default=1.0)
     def __init__(self, **kwargs):
-        super().__init__(**kwargs)
\ No newline at end of file
+        super().__init__(**kwargs)
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'))
+    folder = db.Column(db.String(100))
+    original_filename = db.Column(db.String(256), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+class Job(db.Model):
+    __tablename__ = 'job'
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    blob_id = db.Column(db.Integer, index=True)
+    audio_id = db.Column(db.Integer, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
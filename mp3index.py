@@ -0,0 +1,207 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import mmap
+import os
+import struct
+
+MAGIC = b'DDMX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIIII')
+
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+def parse_header(b0, b1, b2, b3):
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version_bits = (b1 >> 3) & 0x3
+    layer = 4 - ((b1 >> 1) & 0x3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x3
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    lsf = version_bits != 3
+    bitrate = BITRATES[(2 if lsf else 1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][rate_index]
+    padding = (b2 >> 1) & 0x1
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+        samples = 384
+    elif layer == 2 or not lsf:
+        length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    mono = (b3 >> 6) == 3
+    return length, samples, sample_rate, lsf, mono
+
+
+def _skip_id3v2(data):
+    if len(data) >= 10 and data[:3] == b'ID3':
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def _audio_end(data):
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    if end >= 32 and data[end - 32:end - 24] == b'APETAGEX':
+        size = struct.unpack_from('<I', data, end - 20)[0]
+        end -= size + (32 if struct.unpack_from('<I', data, end - 12)[0] & 0x80000000 else 0)
+    return max(end, 0)
+
+
+def _vbr_header(data, pos, length, lsf, mono):
+    # Xing/Info (LAME) and VBRI headers live in a frame that carries no audio.
+    # The LAME tag also records encoder delay and end padding for exact length.
+    side_info = (9 if mono else 17) if lsf else (17 if mono else 32)
+    tag = pos + 4 + side_info
+    if data[tag:tag + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack_from('>I', data, tag + 4)[0]
+        lame = tag + 8 + (4 if flags & 1 else 0) + (4 if flags & 2 else 0) + \
+            (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+        delay = padding = 0
+        if lame + 24 <= pos + length and data[lame:lame + 4] == b'LAME':
+            b0, b1, b2 = data[lame + 21], data[lame + 22], data[lame + 23]
+            delay = (b0 << 4) | (b1 >> 4)
+            padding = ((b1 & 0x0F) << 8) | b2
+        return delay, padding
+    if data[pos + 36:pos + 40] == b'VBRI':
+        return struct.unpack_from('>H', data, pos + 36 + 6)[0], 0
+    return None
+
+
+class Mp3Index:
+    def __init__(self, sample_rate, offsets, samples, audio_end, delay=0, padding=0):
+        self.sample_rate = sample_rate
+        self.offsets = offsets
+        self.samples = samples
+        self.audio_end = audio_end
+        self.delay = delay
+        self.padding = padding
+
+    @property
+    def frame_count(self):
+        return len(self.offsets)
+
+    @property
+    def duration(self):
+        if not self.offsets or not self.sample_rate:
+            return None
+        return max(self.samples[-1] - self.delay - self.padding, 0) / self.sample_rate
+
+    def byte_span(self, start_time, end_time):
+        if not self.offsets or end_time <= start_time:
+            return None
+        start_sample = max(int(start_time * self.sample_rate), 0) + self.delay
+        end_sample = int(end_time * self.sample_rate) + self.delay
+        first = max(bisect_right(self.samples, start_sample) - 1, 0)
+        last = bisect_left(self.samples, end_sample, lo=first + 1)
+        if first >= self.frame_count:
+            return None
+        end = self.offsets[last] if last < self.frame_count else self.audio_end
+        return self.offsets[first], end
+
+    def to_bytes(self):
+        header = HEADER.pack(MAGIC, VERSION, 0, self.sample_rate, len(self.offsets),
+                             self.audio_end, self.delay, self.padding, 0)
+        return header + self.offsets.tobytes() + self.samples[1:].tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        if len(blob) < HEADER.size:
+            raise ValueError('truncated mp3 seek table')
+        magic, version, _, sample_rate, count, audio_end, delay, padding, _ = HEADER.unpack_from(blob)
+        if magic != MAGIC or version != VERSION or len(blob) != HEADER.size + 8 * count:
+            raise ValueError('not an mp3 seek table')
+        offsets = array('I')
+        offsets.frombytes(blob[HEADER.size:HEADER.size + 4 * count])
+        samples = array('I', [0])
+        samples.frombytes(blob[HEADER.size + 4 * count:HEADER.size + 8 * count])
+        return cls(sample_rate, offsets, samples, audio_end, delay, padding)
+
+
+def build_index(path):
+    offsets = array('I')
+    # samples[i] is the first sample of frame i; the final entry is the total.
+    samples = array('I', [0])
+    sample_rate = 0
+    delay = padding = 0
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return Mp3Index(0, offsets, samples, 0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = _skip_id3v2(data)
+            end = _audio_end(data)
+            first = True
+            while pos + 4 <= end:
+                header = parse_header(data[pos], data[pos + 1], data[pos + 2], data[pos + 3])
+                if header is None or pos + header[0] > end:
+                    nxt = data.find(b'\xff', pos + 1, end)
+                    if nxt < 0:
+                        break
+                    pos = nxt
+                    continue
+                length, frame_samples, rate, lsf, mono = header
+                if first:
+                    first = False
+                    vbr = _vbr_header(data, pos, length, lsf, mono)
+                    if vbr is not None:
+                        delay, padding = vbr
+                        pos += length
+                        continue
+                if offsets and rate != sample_rate:
+                    # A rate change mid-stream is almost always a false sync.
+                    pos += 1
+                    continue
+                sample_rate = rate
+                offsets.append(pos)
+                samples.append(samples[-1] + frame_samples)
+                pos += length
+            audio_end = min(pos, end)
+    return Mp3Index(sample_rate, offsets, samples, audio_end, delay, padding)
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+
+def write_index(path):
+    index = build_index(path)
+    sidecar = index_path(path)
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(index.to_bytes())
+    os.replace(tmp_path, sidecar)
+    return index
+
+
+@lru_cache(maxsize=64)
+def _load(sidecar, mtime_ns):
+    with open(sidecar, 'rb') as f:
+        return Mp3Index.from_bytes(f.read())
+
+
+def load_index(path):
+    sidecar = index_path(path)
+    try:
+        return _load(sidecar, os.stat(sidecar).st_mtime_ns)
+    except (FileNotFoundError, ValueError):
+        return write_index(path)
@@ -0,0 +1,37 @@
+from sqlalchemy import and_, or_
+from datetime import datetime
+import base64
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that did not come from encode_cursor.
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(padded).decode().split('|')
+    except (UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError('malformed cursor') from e
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def keyset_page(query, time_column, id_column, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    # Newest first. The cursor is the (time, id) of the last row already shown,
+    # so each page is a bounded range scan of a (..., time, id) index rather
+    # than an OFFSET that has to walk every earlier row.
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(or_(time_column < timestamp,
+                                 and_(time_column == timestamp, id_column < row_id)))
+    rows = query.order_by(time_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, time_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
@@ -0,0 +1,67 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.005
+MAX_DEPTH = 128
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def collapse(frame):
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    # Samples one thread's stack from a helper thread, so the profiled code
+    # runs unmodified and the cost is one stack walk per interval. Output is
+    # the collapsed-stack format flamegraph.pl and speedscope read. Needs
+    # real threads: under gevent every greenlet shares one OS thread.
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.folded())
+        os.replace(tmp_path, path)
+        return path
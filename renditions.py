@@ -0,0 +1,208 @@
+from audio_io import stream_pcm, file_info
+import lameenc
+import math
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+import os
+
+FRAME = 2048
+HOP = FRAME // 2
+TOLERANCE = 512
+DECIMATE = 4
+WINDOW = np.hanning(FRAME + 1)[:-1].astype(np.float32)
+MIN_SPEED = 0.5
+MAX_SPEED = 1.25
+SPEED_STEP = 0.05
+BITRATE = 160
+DEFAULT_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def cache_for(config):
+    return RenditionCache(config['RENDITION_CACHE_DIR'], config['RENDITION_CACHE_BYTES'])
+
+
+def cache_key(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def normalize_speed(speed):
+    # Clamp before snapping so huge values cannot overflow the rounding.
+    if not math.isfinite(speed):
+        raise ValueError(f'speed must be finite, got {speed!r}')
+    speed = min(max(speed, MIN_SPEED), MAX_SPEED)
+    return round(round(speed / SPEED_STEP) * SPEED_STEP, 2)
+
+
+class Stretcher:
+    # WSOLA: output frames are laid down every HOP samples; each one is taken
+    # from near speed * HOP input samples further on, shifted by up to
+    # TOLERANCE samples to best match the natural continuation of the
+    # previous frame, so the waveform stays coherent and the pitch unchanged.
+    def __init__(self, speed, channels):
+        self.analysis_hop = HOP * speed
+        self.channels = channels
+        self.buffer = np.zeros((0, channels), dtype=np.float32)
+        self.mono = np.zeros(0, dtype=np.float32)
+        self.base = 0
+        self.frame_index = 0
+        self.previous = None
+        self.pending = np.zeros((FRAME, channels), dtype=np.float32)
+
+    def _best_position(self, nominal):
+        if self.previous is None:
+            return nominal
+        lo = max(nominal - TOLERANCE, 0)
+        hi = nominal + TOLERANCE
+        start = self.previous + HOP - self.base
+        template = self.mono[start:start + FRAME]
+        region = self.mono[lo - self.base:hi + FRAME - self.base]
+        # Coarse search on a decimated signal, then refine at full rate.
+        coarse_region = region[::DECIMATE]
+        coarse_template = template[::DECIMATE]
+        size = 1 << int(len(coarse_region) + len(coarse_template) - 1).bit_length()
+        corr = np.fft.irfft(np.fft.rfft(coarse_region, size) * np.conj(np.fft.rfft(coarse_template, size)), size)
+        coarse = int(np.argmax(corr[:len(coarse_region) - len(coarse_template) + 1])) * DECIMATE
+        first = max(coarse - DECIMATE, 0)
+        last = min(coarse + DECIMATE, hi - lo)
+        windows = sliding_window_view(region[first:last + FRAME], FRAME)
+        return lo + first + int(np.argmax(windows @ template))
+
+    def _needed(self, nominal):
+        need = nominal + TOLERANCE + FRAME
+        if self.previous is not None:
+            need = max(need, self.previous + HOP + FRAME)
+        return need
+
+    def _run(self, available_end):
+        out = []
+        while True:
+            nominal = int(round(self.frame_index * self.analysis_hop))
+            if self._needed(nominal) > available_end:
+                break
+            position = self._best_position(nominal)
+            frame = self.buffer[position - self.base:position - self.base + FRAME]
+            self.pending += frame * WINDOW[:, None]
+            out.append(self.pending[:HOP].copy())
+            self.pending = np.concatenate((self.pending[HOP:], np.zeros((HOP, self.channels), np.float32)))
+            self.previous = position
+            self.frame_index += 1
+            keep = min(int(round(self.frame_index * self.analysis_hop)) - TOLERANCE, position + HOP)
+            drop = max(keep - self.base, 0)
+            if drop:
+                self.buffer = self.buffer[drop:]
+                self.mono = self.mono[drop:]
+                self.base += drop
+        return np.concatenate(out) if out else np.zeros((0, self.channels), np.float32)
+
+    def _append(self, block):
+        self.buffer = np.concatenate((self.buffer, block))
+        self.mono = np.concatenate((self.mono, block.mean(axis=1)))
+
+    def push(self, block):
+        self._append(block)
+        return self._run(self.base + len(self.buffer))
+
+    def flush(self):
+        end = self.base + len(self.buffer)
+        self._append(np.zeros((2 * (FRAME + TOLERANCE), self.channels), np.float32))
+        out = []
+        while int(round(self.frame_index * self.analysis_hop)) < end:
+            produced = self._run(self.base + len(self.buffer))
+            if not len(produced):
+                self._append(np.zeros((FRAME, self.channels), np.float32))
+                continue
+            out.append(produced)
+        out.append(self.pending[:FRAME - HOP])
+        return np.concatenate(out)
+
+
+def _pcm16(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def render(path, speed):
+    info = file_info(path)
+    channels = min(info.nchannels, 2)
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(BITRATE)
+    encoder.set_in_sample_rate(info.sample_rate)
+    encoder.set_channels(channels)
+    encoder.set_quality(5)
+    stretcher = Stretcher(speed, channels)
+    for block in stream_pcm(path, channels=channels, sample_rate=info.sample_rate):
+        if channels == 1:
+            block = block[:, None]
+        data = encoder.encode(_pcm16(stretcher.push(block)))
+        if data:
+            yield bytes(data)
+    data = encoder.encode(_pcm16(stretcher.flush()))
+    if data:
+        yield bytes(data)
+    yield bytes(encoder.flush())
+
+
+class RenditionCache:
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path_for(self, digest, speed):
+        return os.path.join(self.root, f"{digest}-{int(round(speed * 100)):03d}.mp3")
+
+    def lookup(self, digest, speed):
+        path = self.path_for(digest, speed)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def remove(self, digest):
+        # Every speed normalize_speed() can produce, so nothing outlives the
+        # source once its last reference is released.
+        step = int(round(SPEED_STEP * 100))
+        for percent in range(int(round(MIN_SPEED * 100)), int(round(MAX_SPEED * 100)) + 1, step):
+            try:
+                os.remove(self.path_for(digest, percent / 100))
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.mp3'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stream(self, source, digest, speed):
+        # Yields encoded bytes as they are rendered while teeing them into a
+        # temp file, which only becomes a cache entry if rendering completes.
+        os.makedirs(self.root, exist_ok=True)
+        final_path = self.path_for(digest, speed)
+        tmp_path = f"{final_path}.{os.getpid()}.{id(self)}.part"
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as out:
+                for data in render(source, speed):
+                    out.write(data)
+                    yield data
+            os.replace(tmp_path, final_path)
+            completed = True
+            self.evict()
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def build(self, source, digest, speed):
+        for _ in self.stream(source, digest, speed):
+            pass
+        return self.path_for(digest, speed)
@@ -1,9 +1,21 @@
-from flask import request, jsonify, current_app, send_from_directory, render_template, redirect, url_for, session, flash
+from flask import request, jsonify, current_app, send_from_directory, render_template, redirect, url_for, session, flash, abort, Response
 from models import db, User, AudioFile, Team, TeamMember, TeamUpload
-from extensions import bcrypt
+from extensions import bcrypt, cache
+from markupsafe import Markup
+from byteserve import send_audio, content_disposition
+import blobstore
+import mp3index
+import waveform
+import jobs
+import renditions
+from pagination import keyset_page
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload
+from datetime import datetime
+from audio_io import DecodeError
+import math
 import os
-from werkzeug.utils import secure_filename
-from models import Loop, Note, AudioSetting
+from models import Loop, Note, AudioSetting, Job
 import secrets
 
 ALLOWED_EXTENSIONS = {'mp3'}
@@ -11,6 +23,79 @@ ALLOWED_EXTENSIONS = {'mp3'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def peaks_response(filename, blob_id=None):
+    start = request.args.get('start', 0.0, type=float)
+    end = request.args.get('end', type=float)
+    width = min(max(request.args.get('width', 1000, type=int), 1), 8192)
+    if not math.isfinite(start) or start < 0 or (end is not None and not (math.isfinite(end) and end >= start)):
+        abort(400)
+    path = blobstore.absolute_path(filename)
+    sidecar = waveform.peaks_path(path)
+    if blob_id is not None and not os.path.exists(sidecar):
+        latest = Job.query.filter_by(blob_id=blob_id, kind='process_blob').order_by(Job.id.desc()).first()
+        # Under a remote backend the working copy and its sidecars can be
+        # lost and fetched again. A copy newer than the finished job means
+        # the job's output is gone, not that decoding failed.
+        stale = latest is not None and latest.status not in jobs.ACTIVE and (
+            not os.path.exists(path) or datetime.utcfromtimestamp(os.path.getmtime(path)) > latest.finished_at)
+        if latest is not None and latest.status not in jobs.ACTIVE and not stale:
+            abort(404)
+        if latest is None or stale:
+            jobs.enqueue('process_blob', blob_id=blob_id)
+            db.session.commit()
+        return jsonify(pending=True), 202
+    try:
+        if not os.path.exists(sidecar):
+            path = blobstore.local_path(filename)
+        sidecar = waveform.ensure_peaks(path)
+    except (FileNotFoundError, DecodeError):
+        abort(404)
+    response = jsonify(waveform.read_window(sidecar, start, end, width))
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config.get('AUDIO_CACHE_MAX_AGE', 365 * 24 * 3600)
+    response.add_etag()
+    return response.make_conditional(request)
+
+def set_speed(audio, speed):
+    speed = renditions.normalize_speed(speed)
+    setting = audio.settings or AudioSetting(audiofile_id=audio.id)
+    setting.speed = speed
+    db.session.add(setting)
+    key = renditions.cache_key(audio.filename)
+    if speed != 1.0 and renditions.cache_for(current_app.config).lookup(key, speed) is None:
+        jobs.enqueue('render_rendition', user_id=audio.user_id, audio_id=audio.id, speed=speed)
+    return speed
+
+def page_args():
+    cursor = request.args.get('cursor') or None
+    limit = min(max(request.args.get('limit', current_app.config.get('PAGE_SIZE', 50), type=int), 1), 500)
+    return cursor, limit
+
+def is_team_member(team_id, user_id):
+    key = f"member:{team_id}:{user_id}:{cache.generation(f'team-members:{team_id}')}"
+    # Only memberships are cached: a miss is checked again every time, so
+    # someone who has just joined is never turned away by a stale entry.
+    if cache.get(key):
+        return True
+    member = TeamMember.query.filter_by(team_id=team_id, user_id=user_id).first() is not None
+    if member:
+        cache.set(key, member)
+    return member
+
+def render_team_listing(team, folder, cursor, limit):
+    team_id = team.id
+    query = TeamUpload.query.filter_by(team_id=team_id).options(joinedload(TeamUpload.user))
+    if folder:
+        query = query.filter_by(folder=folder)
+    try:
+        uploads, next_cursor = keyset_page(query, TeamUpload.uploaded_at, TeamUpload.id, cursor, limit)
+    except ValueError:
+        abort(400)
+    folder_counts = db.session.query(TeamUpload.folder, func.count(TeamUpload.id)).filter_by(
+        team_id=team_id).group_by(TeamUpload.folder).order_by(TeamUpload.folder).all()
+    return render_template('_team_listing.html', team=team, uploads=uploads, folders=folder_counts,
+                           folder=folder, cursor=cursor, next_cursor=next_cursor)
+
 def login_required(f):
     from functools import wraps
     @wraps(f)
@@ -29,8 +114,7 @@ def team_member_required(f):
         team_id = kwargs.get('team_id')
         if not team_id:
             return redirect(url_for('dashboard'))
-        membership = TeamMember.query.filter_by(team_id=team_id, user_id=session['user_id']).first()
-        if not membership:
+        if not is_team_member(team_id, session['user_id']):
             flash('You are not a member of this team.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -100,6 +184,7 @@ def register_routes(app):
             db.session.commit()
             member = TeamMember(team_id=team.id, user_id=session['user_id'])
             db.session.add(member)
+            cache.invalidate(f'team-members:{team.id}')
             db.session.commit()
             flash('Team created successfully!', 'success')
             return redirect(url_for('team_dashboard', team_id=team.id))
@@ -124,6 +209,7 @@ def register_routes(app):
                 return redirect(url_for('team_dashboard', team_id=team.id))
             member = TeamMember(team_id=team.id, user_id=session['user_id'])
             db.session.add(member)
+            cache.invalidate(f'team-members:{team.id}')
             db.session.commit()
             flash('Joined team successfully!', 'success')
             return redirect(url_for('team_dashboard', team_id=team.id))
@@ -133,10 +219,15 @@ def register_routes(app):
     @team_member_required
     def team_dashboard(team_id):
         team = Team.query.get_or_404(team_id)
-        uploads = TeamUpload.query.filter_by(team_id=team_id).order_by(TeamUpload.uploaded_at.desc()).all()
-        folders = db.session.query(TeamUpload.folder).filter_by(team_id=team_id).distinct().all()
-        folders = [folder[0] for folder in folders]
-        return render_template('team_dashboard.html', team=team, uploads=uploads, folders=folders)
+        folder = request.args.get('folder') or None
+        cursor, limit = page_args()
+        generation = cache.generation(f'team-uploads:{team_id}')
+        key = f"team-listing:{team_id}:{generation}:{session['user_id']}:{folder}:{cursor}:{limit}"
+        listing = cache.get(key)
+        if listing is None:
+            listing = render_team_listing(team, folder, cursor, limit)
+            cache.set(key, listing)
+        return render_template('team_dashboard.html', team=team, listing=Markup(listing))
 
     @app.route('/teams/<int:team_id>/upload', methods=['GET', 'POST'])
     @team_member_required
@@ -151,23 +242,19 @@ def register_routes(app):
             if not file or not file.filename or not allowed_file(file.filename):
                 flash('Invalid file type. Only MP3 files are allowed.', 'danger')
                 return redirect(url_for('team_upload', team_id=team_id))
-            filename = secure_filename(file.filename or "")
-            save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(save_path):
-                filename = f"{base}_{counter}{ext}"
-                save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                counter += 1
-            file.save(save_path)
+            blob = blobstore.store_upload(file)
             upload = TeamUpload(
                 team_id=team_id,
                 user_id=session['user_id'],
-                filename=filename,
+                filename=blob.filename,
                 original_filename=file.filename,
-                folder=folder
+                folder=folder,
+                blob_id=blob.id
             )
             db.session.add(upload)
+            jobs.enqueue('process_blob', user_id=session['user_id'], blob_id=blob.id)
+            jobs.enqueue('analyse_team_upload', user_id=session['user_id'], blob_id=blob.id, upload_id=upload.id)
+            cache.invalidate(f'team-uploads:{team_id}')
             db.session.commit()
             flash('File uploaded to team successfully!', 'success')
             return redirect(url_for('team_dashboard', team_id=team_id))
@@ -177,17 +264,33 @@ def register_routes(app):
     @team_member_required
     def download_team_file(team_id, upload_id):
         upload = TeamUpload.query.filter_by(id=upload_id, team_id=team_id).first_or_404()
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], upload.filename)
-        if not os.path.exists(file_path):
+        try:
+            return blobstore.send(upload.filename, download_name=upload.original_filename, as_attachment=True)
+        except FileNotFoundError:
             flash('File not found on server.', 'danger')
             return redirect(url_for('team_dashboard', team_id=team_id))
-        from flask import send_file
-        return send_file(
-            file_path,
-            mimetype='audio/mpeg',
-            as_attachment=True,
-            download_name=upload.original_filename
-        )
+
+    @app.route('/teams/<int:team_id>/peaks/<int:upload_id>')
+    @team_member_required
+    def team_file_peaks(team_id, upload_id):
+        upload = TeamUpload.query.filter_by(id=upload_id, team_id=team_id).first_or_404()
+        return peaks_response(upload.filename, upload.blob_id)
+
+    @app.route('/teams/<int:team_id>/analyse', methods=['POST'])
+    @team_member_required
+    def analyse_team_folder(team_id):
+        folder = request.form.get('folder', 'General')
+        jobs.enqueue('analyse_team_folder', user_id=session['user_id'], team_id=team_id, folder=folder)
+        db.session.commit()
+        flash(f'Beat detection queued for {folder}.', 'info')
+        return redirect(url_for('team_dashboard', team_id=team_id))
+
+    @app.route('/teams/<int:team_id>/jobs')
+    @team_member_required
+    def team_jobs(team_id):
+        blob_ids = db.session.query(TeamUpload.blob_id).filter(TeamUpload.team_id == team_id)
+        pending = Job.query.filter(Job.blob_id.in_(blob_ids), Job.status.in_(jobs.ACTIVE)).count()
+        return jsonify(pending=pending)
 
     @app.route('/teams/<int:team_id>/delete/<int:upload_id>', methods=['POST'])
     @team_member_required
@@ -196,11 +299,11 @@ def register_routes(app):
         if upload.user_id != session['user_id']:
             flash('You can only delete your own uploads.', 'danger')
             return redirect(url_for('team_dashboard', team_id=team_id))
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], upload.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
         db.session.delete(upload)
+        orphans = blobstore.release(upload)
+        cache.invalidate(f'team-uploads:{team_id}')
         db.session.commit()
+        blobstore.purge(orphans)
         flash('File deleted successfully.', 'success')
         return redirect(url_for('team_dashboard', team_id=team_id))
 
@@ -217,24 +320,26 @@ def register_routes(app):
             if not file or not file.filename or not allowed_file(file.filename):
                 flash('Invalid file type.', 'danger')
                 return redirect(url_for('dashboard'))
-            filename = secure_filename(file.filename or "")
-            save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(save_path):
-                filename = f"{base}_{counter}{ext}"
-                save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                counter += 1
-            file.save(save_path)
-            audio = AudioFile(user_id=user_id, filename=filename, original_filename=file.filename)
+            blob = blobstore.store_upload(file)
+            audio = AudioFile(user_id=user_id, filename=blob.filename, original_filename=file.filename, blob_id=blob.id)
             db.session.add(audio)
+            jobs.enqueue('process_blob', user_id=user_id, blob_id=blob.id)
+            jobs.enqueue('analyse_audio', user_id=user_id, audio_id=audio.id)
             db.session.commit()
             flash('File uploaded successfully!', 'success')
             return redirect(url_for('dashboard'))
-        audio_files = AudioFile.query.filter_by(user_id=user_id).order_by(AudioFile.upload_date.desc()).all()
-        user_teams = TeamMember.query.filter_by(user_id=user_id).all()
-        teams = [Team.query.get(member.team_id) for member in user_teams]
-        return render_template('dashboard.html', username=username, audio_files=audio_files, teams=teams)
+        cursor, limit = page_args()
+        try:
+            audio_files, next_cursor = keyset_page(AudioFile.query.filter_by(user_id=user_id),
+                                                   AudioFile.upload_date, AudioFile.id, cursor, limit)
+        except ValueError:
+            abort(400)
+        audio_count = db.session.query(func.count(AudioFile.id)).filter_by(user_id=user_id).scalar()
+        memberships = TeamMember.query.filter_by(user_id=user_id).options(
+            joinedload(TeamMember.team)).order_by(TeamMember.joined_at).all()
+        return render_template('dashboard.html', username=username, audio_files=audio_files,
+                               audio_count=audio_count, memberships=memberships,
+                               cursor=cursor, next_cursor=next_cursor)
 
     @app.route('/audio/<int:audio_id>', methods=['GET', 'POST'])
     @login_required
@@ -250,6 +355,7 @@ def register_routes(app):
                 if start_time is not None and end_time is not None:
                     loop = Loop(audiofile_id=audio.id, start_time=start_time, end_time=end_time, label=label)
                     db.session.add(loop)
+                    audio.revision = AudioFile.revision + 1
                     db.session.commit()
                     flash('Loop added!', 'success')
                 return redirect(url_for('audio_detail', audio_id=audio.id))
@@ -259,6 +365,7 @@ def register_routes(app):
                 if timestamp is not None and text:
                     note = Note(audiofile_id=audio.id, timestamp=timestamp, text=text)
                     db.session.add(note)
+                    audio.revision = AudioFile.revision + 1
                     db.session.commit()
                     flash('Note added!', 'success')
                 return redirect(url_for('audio_detail', audio_id=audio.id))
@@ -267,12 +374,13 @@ def register_routes(app):
                 note = Note.query.filter_by(id=note_id, audiofile_id=audio.id).first()
                 if note:
                     db.session.delete(note)
+                    audio.revision = AudioFile.revision + 1
                     db.session.commit()
                     flash('Note deleted!', 'success')
                 return redirect(url_for('audio_detail', audio_id=audio.id))
         loops = Loop.query.filter_by(audiofile_id=audio.id).all()
-        notes = Note.query.filter_by(audiofile_id=audio.id).all()
-        return render_template('audio_detail.html', audio=audio, loops=loops, notes=notes)
+        speed = audio.settings.speed if audio.settings and audio.settings.speed else 1.0
+        return render_template('audio_detail.html', audio=audio, loops=loops, speed=speed)
 
     @app.route('/audio/<int:audio_id>/download')
     @login_required
@@ -280,44 +388,110 @@ def register_routes(app):
         user_id = session['user_id']
         audio = AudioFile.query.filter_by(id=audio_id, user_id=user_id).first_or_404()
         
-        upload_folder = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
-        file_path = os.path.join(upload_folder, audio.filename)
-        
-        print(f"Looking for file: {file_path}")
-        print(f"File exists: {os.path.exists(file_path)}")
-        print(f"Upload folder: {upload_folder}")
-        print(f"Audio filename: {audio.filename}")
-        print(f"Current working directory: {os.getcwd()}")
-        
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
+        try:
+            return blobstore.send(audio.filename, download_name=audio.original_filename)
+        except FileNotFoundError:
+            current_app.logger.warning('Audio file missing for audio %s: %s', audio.id, audio.filename)
             flash('Audio file not found on server.', 'danger')
             return redirect(url_for('dashboard'))
-        
-        from flask import send_file
+
+    @app.route('/audio/<int:audio_id>/loops/<int:loop_id>.mp3')
+    @login_required
+    def download_loop(audio_id, loop_id):
+        user_id = session['user_id']
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=user_id).first_or_404()
+        loop = Loop.query.filter_by(id=loop_id, audiofile_id=audio.id).first_or_404()
         try:
-            return send_file(
-                file_path,
-                mimetype='audio/mpeg',
-                as_attachment=False
-            )
-        except Exception as e:
-            print(f"Error sending file: {e}")
-            flash('Error serving audio file.', 'danger')
-            return redirect(url_for('dashboard'))
+            file_path = blobstore.local_path(audio.filename)
+            span = mp3index.load_index(file_path).byte_span(loop.start_time, loop.end_time)
+        except FileNotFoundError:
+            abort(404)
+        if span is None:
+            abort(416)
+        download_name = f"{loop.label or 'loop'}.mp3"
+        return send_audio(file_path, download_name=download_name, span=span)
+
+    @app.route('/audio/<int:audio_id>/rendition')
+    @login_required
+    def audio_rendition(audio_id):
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        try:
+            speed = renditions.normalize_speed(request.args.get('speed', 1.0, type=float))
+        except ValueError:
+            abort(400)
+        if speed == 1.0:
+            return redirect(url_for('download_audio', audio_id=audio.id))
+        cache = renditions.cache_for(current_app.config)
+        key = renditions.cache_key(audio.filename)
+        download_name = f"{os.path.splitext(audio.original_filename)[0]} ({speed:g}x).mp3"
+        cached = cache.lookup(key, speed)
+        if cached is not None:
+            return send_audio(cached, download_name=download_name)
+        try:
+            source = blobstore.local_path(audio.filename)
+        except FileNotFoundError:
+            abort(404)
+        return Response(cache.stream(source, key, speed), mimetype='audio/mpeg', headers={
+            'Cache-Control': 'no-store',
+            'Content-Disposition': content_disposition(download_name, False),
+        })
+
+    @app.route('/audio/<int:audio_id>/settings', methods=['POST'])
+    @login_required
+    def audio_settings(audio_id):
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        try:
+            speed = set_speed(audio, request.form.get('speed', 1.0, type=float))
+        except ValueError:
+            return jsonify(error='Speed must be a finite number.'), 400
+        audio.revision = AudioFile.revision + 1
+        db.session.commit()
+        return jsonify(speed=speed, src=url_for('audio_rendition', audio_id=audio.id, speed=speed))
+
+    @app.route('/audio/<int:audio_id>/peaks')
+    @login_required
+    def audio_peaks(audio_id):
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        return peaks_response(audio.filename, audio.blob_id)
+
+    @app.route('/audio/<int:audio_id>/analyse', methods=['POST'])
+    @login_required
+    def analyse_audio(audio_id):
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        jobs.enqueue('analyse_audio', user_id=audio.user_id, audio_id=audio.id)
+        db.session.commit()
+        flash('Loop suggestions are being generated.', 'info')
+        return redirect(url_for('audio_detail', audio_id=audio.id))
+
+    @app.route('/audio/<int:audio_id>/jobs')
+    @login_required
+    def audio_jobs(audio_id):
+        audio = AudioFile.query.filter_by(id=audio_id, user_id=session['user_id']).first_or_404()
+        # Decoding jobs belong to the blob, analysis and renditions to this
+        # file and its owner.
+        mine = (Job.audio_id == audio.id) & (Job.user_id == audio.user_id)
+        recent = Job.query.filter(or_(Job.blob_id == audio.blob_id, mine) if audio.blob_id else mine).order_by(
+            Job.id.desc()).limit(10).all()
+        pending = sum(1 for job in recent if job.status in jobs.ACTIVE)
+        return jsonify(pending=pending, jobs=[jobs.describe(job) for job in recent])
+
+    @app.route('/jobs/<int:job_id>')
+    @login_required
+    def job_status(job_id):
+        job = Job.query.filter_by(id=job_id, user_id=session['user_id']).first_or_404()
+        return jsonify(jobs.describe(job))
 
     @app.route('/audio/<int:audio_id>/delete', methods=['POST'])
     @login_required
     def delete_audio(audio_id):
         user_id = session['user_id']
         audio = AudioFile.query.filter_by(id=audio_id, user_id=user_id).first_or_404()
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], audio.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
         Loop.query.filter_by(audiofile_id=audio.id).delete()
         Note.query.filter_by(audiofile_id=audio.id).delete()
         AudioSetting.query.filter_by(audiofile_id=audio.id).delete()
         db.session.delete(audio)
+        orphans = blobstore.release(audio)
         db.session.commit()
+        blobstore.purge(orphans)
         flash('Audio file deleted.', 'success')
         return redirect(url_for('dashboard')) 
\ No newline at end of file
@@ -0,0 +1,390 @@
+from flask import request, jsonify, render_template, session, url_for, current_app
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, String, Float, Index, event, inspect, select, insert, delete, func, case, distinct, or_, text
+from models import db, AudioFile, TeamUpload, TeamMember, Team, Loop, Note
+from routes import login_required
+from collections import Counter
+import re
+import unicodedata
+
+MAX_RESULTS = 100
+MAX_TERMS = 8
+BATCH_SIZE = 500
+_TOKEN = re.compile(r'[^\W_]+')
+
+# Every searchable row gets one index entry, keyed by its id with the kind
+# packed into the low bits so an update or delete finds the entry by
+# primary key. The scope is the user ("u12") or team ("t3") that may see
+# the row; it is indexed as a term, so visibility narrows the candidate set
+# inside the index instead of filtering the matches afterwards.
+SOURCES = {
+    'audio': {
+        'model': AudioFile, 'table': 'audiofile', 'code': 0, 'columns': ('original_filename',),
+        'body': "{row}.original_filename",
+        'scope': "'u' || {row}.user_id",
+        'parent': "{row}.id",
+    },
+    'team_upload': {
+        'model': TeamUpload, 'table': 'team_upload', 'code': 1, 'columns': ('original_filename', 'folder'),
+        'body': "{row}.original_filename || ' ' || coalesce({row}.folder, '')",
+        'scope': "'t' || {row}.team_id",
+        'parent': "{row}.team_id",
+    },
+    'loop': {
+        'model': Loop, 'table': 'loop', 'code': 2, 'columns': ('label',),
+        'body': "coalesce({row}.label, '')",
+        'scope': "'u' || (SELECT user_id FROM audiofile WHERE id = {row}.audiofile_id)",
+        'parent': "{row}.audiofile_id",
+    },
+    'note': {
+        'model': Note, 'table': 'note', 'code': 3, 'columns': ('text',),
+        'body': "coalesce({row}.text, '')",
+        'scope': "'u' || (SELECT user_id FROM audiofile WHERE id = {row}.audiofile_id)",
+        'parent': "{row}.audiofile_id",
+    },
+}
+KINDS = {source['model']: kind for kind, source in SOURCES.items()}
+TABLES = {source['table']: kind for kind, source in SOURCES.items()}
+
+
+def _doc(kind, row_id):
+    return row_id * 4 + SOURCES[kind]['code']
+
+
+def tokenize(value):
+    # Matches FTS5's unicode61 tokenizer with remove_diacritics, so both
+    # backends split and fold text the same way.
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return _TOKEN.findall(value.lower())
+
+
+def parse_query(q):
+    # Every term must match; the last one also matches as a prefix so
+    # results appear while the user is still typing. A trailing space marks
+    # the last word as finished.
+    terms = list(dict.fromkeys(tokenize(q)))[:MAX_TERMS]
+    prefix = bool(terms) and len(terms[-1]) > 1 and not q[-1:].isspace()
+    return terms, prefix
+
+
+class FtsIndex:
+    # SQLite: one FTS5 table kept current by triggers on the source tables,
+    # so bulk inserts, Query.delete() and raw SQL are all covered.
+    name = 'fts5'
+
+    def install(self, engine):
+        with engine.begin() as conn:
+            fresh = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'").first() is None
+            conn.exec_driver_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                "body, scope, kind UNINDEXED, row_id UNINDEXED, parent_id UNINDEXED, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+            for kind, source in SOURCES.items():
+                self._create_triggers(conn, kind, source)
+            if fresh:
+                for kind, source in SOURCES.items():
+                    conn.exec_driver_sql(
+                        f"INSERT INTO search_index(rowid, body, scope, kind, row_id, parent_id) "
+                        f"SELECT {self._values(kind, source, 'src')} FROM {source['table']} AS src")
+        return fresh
+
+    def _values(self, kind, source, row):
+        return ', '.join([
+            f"{row}.id * 4 + {source['code']}",
+            source['body'].format(row=row),
+            source['scope'].format(row=row),
+            f"'{kind}'",
+            f"{row}.id",
+            source['parent'].format(row=row),
+        ])
+
+    def _create_triggers(self, conn, kind, source):
+        table = source['table']
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO search_index(rowid, body, scope, kind, row_id, parent_id) "
+            f"VALUES ({self._values(kind, source, 'new')}); END")
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_update "
+            f"AFTER UPDATE OF {', '.join(source['columns'])} ON {table} BEGIN "
+            f"UPDATE search_index SET body = {source['body'].format(row='new')} "
+            f"WHERE rowid = new.id * 4 + {source['code']}; END")
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS search_{table}_delete AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM search_index WHERE rowid = old.id * 4 + {source['code']}; END")
+
+    def attach(self, db):
+        pass
+
+    def search(self, terms, prefix, scopes, kind=None, limit=20):
+        # Ranked by bm25() over every match the user may see: the scope
+        # terms are part of the MATCH expression, so rows outside it are
+        # never read, and the scope column is weighted 0 so only the body
+        # affects the score. Ties go to the newest row.
+        phrases = [f'"{term}"' for term in terms]
+        if prefix:
+            phrases[-1] += '*'
+        match = f"body : ({' '.join(phrases)}) AND scope : ({' OR '.join(scopes)})"
+        sql = "SELECT kind, row_id, parent_id FROM search_index WHERE search_index MATCH :match"
+        params = {'match': match, 'limit': limit}
+        if kind:
+            sql += " AND kind = :kind"
+            params['kind'] = kind
+        rows = db.session.execute(text(
+            f"{sql} ORDER BY bm25(search_index, 1.0, 0.0), rowid DESC LIMIT :limit"), params)
+        return [tuple(row) for row in rows]
+
+
+metadata = MetaData()
+search_document = Table(
+    'search_document', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('kind', String(16), nullable=False),
+    Column('row_id', Integer, nullable=False),
+    Column('parent_id', Integer),
+)
+search_posting = Table(
+    'search_posting', metadata,
+    Column('term', String(64), primary_key=True),
+    Column('scope', String(24), primary_key=True),
+    Column('doc', BigInteger, primary_key=True, autoincrement=False),
+    Column('weight', Float, nullable=False),
+    Index('ix_search_posting_doc', 'doc'),
+)
+
+
+class PostingsIndex:
+    # Other databases: a plain term -> document table. Session events keep
+    # it current for unit-of-work flushes and for bulk insert, update and
+    # delete statements run through the session. Writes made with raw SQL
+    # or database-side cascades are not seen.
+    name = 'postings'
+
+    def install(self, engine):
+        with engine.begin() as conn:
+            fresh = not inspect(conn).has_table('search_document')
+            metadata.create_all(conn)
+            if fresh:
+                for kind in SOURCES:
+                    last = 0
+                    while True:
+                        model = SOURCES[kind]['model']
+                        ids = conn.execute(select(model.id).where(model.id > last).order_by(model.id)
+                                           .limit(BATCH_SIZE)).scalars().all()
+                        if not ids:
+                            break
+                        self.reindex(conn, kind, ids)
+                        last = ids[-1]
+        return fresh
+
+    def attach(self, db):
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'do_orm_execute', self._do_orm_execute)
+
+    def _rows(self, conn, kind, ids):
+        if kind == 'audio':
+            query = select(AudioFile.id, AudioFile.original_filename, AudioFile.user_id, AudioFile.id)
+        elif kind == 'team_upload':
+            query = select(TeamUpload.id, TeamUpload.original_filename + ' ' + func.coalesce(TeamUpload.folder, ''),
+                           TeamUpload.team_id, TeamUpload.team_id)
+        else:
+            model = SOURCES[kind]['model']
+            query = select(model.id, model.label if model is Loop else model.text, AudioFile.user_id,
+                           model.audiofile_id).join(AudioFile, AudioFile.id == model.audiofile_id)
+        prefix = 't' if kind == 'team_upload' else 'u'
+        model = SOURCES[kind]['model']
+        for row_id, body, owner, parent_id in conn.execute(query.where(model.id.in_(ids))):
+            yield row_id, body, f'{prefix}{owner}', parent_id
+
+    def remove(self, conn, kind, ids):
+        for start in range(0, len(ids), BATCH_SIZE):
+            docs = [_doc(kind, row_id) for row_id in ids[start:start + BATCH_SIZE]]
+            conn.execute(delete(search_posting).where(search_posting.c.doc.in_(docs)))
+            conn.execute(delete(search_document).where(search_document.c.id.in_(docs)))
+
+    def reindex(self, conn, kind, ids):
+        ids = list(ids)
+        self.remove(conn, kind, ids)
+        for start in range(0, len(ids), BATCH_SIZE):
+            documents, postings = [], []
+            for row_id, body, scope, parent_id in self._rows(conn, kind, ids[start:start + BATCH_SIZE]):
+                doc = _doc(kind, row_id)
+                documents.append({'id': doc, 'kind': kind, 'row_id': row_id, 'parent_id': parent_id})
+                # Weighted by the term's share of the text, so summing them
+                # puts short, dense matches first, close to what bm25() does
+                # for the FTS5 index.
+                tokens = [token[:64] for token in tokenize(body)]
+                for term, count in Counter(tokens).items():
+                    postings.append({'term': term, 'scope': scope, 'doc': doc, 'weight': count / len(tokens)})
+            if documents:
+                conn.execute(insert(search_document), documents)
+            if postings:
+                conn.execute(insert(search_posting), postings)
+
+    def _after_flush(self, session, flush_context):
+        changed, removed = {}, {}
+        for obj in session.new:
+            if type(obj) in KINDS:
+                changed.setdefault(KINDS[type(obj)], set()).add(obj.id)
+        for obj in session.dirty:
+            kind = KINDS.get(type(obj))
+            state = inspect(obj)
+            if kind and any(state.attrs[name].history.has_changes() for name in SOURCES[kind]['columns']):
+                changed.setdefault(kind, set()).add(obj.id)
+        for obj in session.deleted:
+            if type(obj) in KINDS:
+                removed.setdefault(KINDS[type(obj)], set()).add(obj.id)
+        if changed or removed:
+            conn = session.connection()
+            for kind, ids in removed.items():
+                self.remove(conn, kind, sorted(ids))
+            for kind, ids in changed.items():
+                self.reindex(conn, kind, sorted(ids))
+
+    def _do_orm_execute(self, state):
+        if not (state.is_insert or state.is_update or state.is_delete):
+            return None
+        kind = TABLES.get(getattr(getattr(state.statement, 'table', None), 'name', None))
+        if kind is None:
+            return None
+        model = SOURCES[kind]['model']
+        session = state.session
+        if state.is_insert:
+            # Bulk inserts do not report their ids; take everything past the
+            # current maximum. Rows another writer adds meanwhile are just
+            # indexed twice.
+            last = session.execute(select(func.max(model.id))).scalar() or 0
+            result = state.invoke_statement()
+            ids = session.execute(select(model.id).where(model.id > last)).scalars().all()
+            self.reindex(session.connection(), kind, ids)
+            return result
+        query = select(model.id)
+        if state.statement.whereclause is not None:
+            query = query.where(state.statement.whereclause)
+        ids = session.execute(query).scalars().all()
+        result = state.invoke_statement()
+        if state.is_delete:
+            self.remove(session.connection(), kind, ids)
+        else:
+            self.reindex(session.connection(), kind, ids)
+        return result
+
+    def search(self, terms, prefix, scopes, kind=None, limit=20):
+        conditions = [search_posting.c.term == term for term in terms]
+        if prefix:
+            conditions[-1] = search_posting.c.term.startswith(terms[-1])
+        matched_term = case(*[(condition, i) for i, condition in enumerate(conditions)])
+        query = select(search_posting.c.doc, func.sum(search_posting.c.weight).label('score')).where(
+            search_posting.c.scope.in_(scopes), or_(*conditions))
+        if kind:
+            query = query.where(search_posting.c.doc % 4 == SOURCES[kind]['code'])
+        matches = query.group_by(search_posting.c.doc).having(
+            func.count(distinct(matched_term)) == len(terms)
+        ).order_by(func.sum(search_posting.c.weight).desc(), search_posting.c.doc.desc()).limit(limit).subquery()
+        rows = db.session.execute(
+            select(search_document.c.kind, search_document.c.row_id, search_document.c.parent_id)
+            .join(matches, matches.c.doc == search_document.c.id)
+            .order_by(matches.c.score.desc(), search_document.c.id.desc()))
+        return [tuple(row) for row in rows]
+
+
+def _has_fts5(engine):
+    with engine.connect() as conn:
+        options = {row[0] for row in conn.exec_driver_sql('PRAGMA compile_options')}
+    return 'ENABLE_FTS5' in options
+
+
+def init_app(app, db):
+    with app.app_context():
+        engine = db.engine
+        index = FtsIndex() if engine.dialect.name == 'sqlite' and _has_fts5(engine) else PostingsIndex()
+    index.attach(db)
+    app.extensions['search'] = index
+
+
+def current():
+    return current_app.extensions['search']
+
+
+def visible_scopes(user_id):
+    team_ids = db.session.query(TeamMember.team_id).filter(TeamMember.user_id == user_id)
+    return [f'u{user_id}'] + [f't{team_id}' for (team_id,) in team_ids]
+
+
+def _hit_url(hit):
+    if hit['kind'] == 'team_upload':
+        return url_for('team_dashboard', team_id=hit['team_id'], folder=hit['folder'])
+    anchor = f"t={hit['timestamp']:g}" if hit['timestamp'] is not None else None
+    return url_for('audio_detail', audio_id=hit['audio_id'], _anchor=anchor)
+
+
+def search_hits(user_id, q, kind=None, limit=20):
+    terms, prefix = parse_query(q)
+    if not terms:
+        return []
+    matches = current().search(terms, prefix, visible_scopes(user_id), kind, limit)
+
+    # Text and timestamps come from the source rows, one query per kind,
+    # so hits are never stale; entries whose row has gone are dropped.
+    rows = {}
+    for model in (AudioFile, Loop, Note):
+        kind_name = KINDS[model]
+        ids = [row_id for k, row_id, _ in matches if k == kind_name]
+        if ids:
+            rows.update(((kind_name, row.id), row) for row in model.query.filter(model.id.in_(ids)))
+    audio_ids = {parent_id for k, _, parent_id in matches if k != 'team_upload'}
+    audio_names = dict(db.session.query(AudioFile.id, AudioFile.original_filename).filter(
+        AudioFile.id.in_(audio_ids), AudioFile.user_id == user_id)) if audio_ids else {}
+    upload_ids = [row_id for k, row_id, _ in matches if k == 'team_upload']
+    uploads = {}
+    if upload_ids:
+        uploads = {upload.id: (upload, team_name) for upload, team_name in db.session.query(TeamUpload, Team.name)
+                   .join(Team, Team.id == TeamUpload.team_id).filter(TeamUpload.id.in_(upload_ids))}
+
+    hits = []
+    for match_kind, row_id, parent_id in matches:
+        if match_kind == 'team_upload':
+            if row_id not in uploads:
+                continue
+            upload, team_name = uploads[row_id]
+            hit = {'kind': match_kind, 'id': row_id, 'text': upload.original_filename,
+                   'team_id': upload.team_id, 'team': team_name, 'folder': upload.folder, 'timestamp': None}
+        else:
+            if parent_id not in audio_names or (match_kind, row_id) not in rows:
+                continue
+            row = rows[(match_kind, row_id)]
+            hit = {'kind': match_kind, 'id': row_id, 'audio_id': parent_id, 'audio': audio_names[parent_id]}
+            if match_kind == 'audio':
+                hit.update(text=row.original_filename, timestamp=None)
+            elif match_kind == 'loop':
+                hit.update(text=row.label, timestamp=row.start_time, end_time=row.end_time)
+            else:
+                hit.update(text=row.text, timestamp=row.timestamp)
+        hit['url'] = _hit_url(hit)
+        hits.append(hit)
+    return hits
+
+
+def _search_args():
+    q = request.args.get('q', '')
+    kind = request.args.get('kind') or None
+    if kind not in SOURCES:
+        kind = None
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_RESULTS)
+    return q, kind, limit
+
+
+def register_search_routes(app):
+    @app.route('/api/search')
+    @login_required
+    def api_search():
+        q, kind, limit = _search_args()
+        return jsonify(query=q, hits=search_hits(session['user_id'], q, kind, limit))
+
+    @app.route('/search')
+    @login_required
+    def search_page():
+        q, kind, limit = _search_args()
+        hits = search_hits(session['user_id'], q, kind, MAX_RESULTS) if q.strip() else []
+        return render_template('search.html', q=q, kind=kind, hits=hits)
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from sqlalchemy import inspect, literal
+import fcntl
+import os
+import secrets
+
+
+def persistent_secret(path):
+    # Every gunicorn worker, the job worker and its children must agree on
+    # the key, or sessions signed by one are rejected by another. The first
+    # process to get here writes it; os.link only succeeds for one of them,
+    # so the others always read a complete file.
+    try:
+        with open(path) as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secrets.token_hex(32))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+@contextmanager
+def file_lock(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _column_ddl(engine, column):
+    preparer = engine.dialect.identifier_preparer
+    ddl = f'{preparer.format_column(column)} {column.type.compile(dialect=engine.dialect)}'
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        value = literal(default, column.type).compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+        ddl += f' DEFAULT {value}'
+    if not column.nullable:
+        if default is None:
+            raise RuntimeError(f'Cannot add NOT NULL column {column} without a default')
+        ddl += ' NOT NULL'
+    for key in column.foreign_keys:
+        target = key.column
+        ddl += f' REFERENCES {preparer.format_table(target.table)} ({preparer.format_column(target)})'
+    return ddl
+
+
+def add_missing_columns(app, engine, metadata):
+    # create_all never alters a table that already exists, so columns added
+    # to a model later are added here, with their defaults filling old rows.
+    existing = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            present = {column['name'] for column in existing.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    conn.exec_driver_sql(f'ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} '
+                                         f'ADD COLUMN {_column_ddl(engine, column)}')
+                    app.logger.info('Added missing column %s.%s', table.name, column.name)
+
+
+def init_database(app, db):
+    # Serialized across processes on the host: concurrent create_all calls
+    # race between checking for a table and creating it. create_all skips
+    # existing tables entirely, so columns and indexes added to a model
+    # later are created here for databases that predate them.
+    with file_lock(app.config['STARTUP_LOCK_PATH']), app.app_context():
+        db.create_all()
+        add_missing_columns(app, db.engine, db.metadata)
+        existing = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            present = {index['name'] for index in existing.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in present:
+                    index.create(db.engine)
+                    app.logger.info('Created missing index %s', index.name)
+        # The search index is built from existing rows the first time, so
+        # this also has to run once per database under the lock.
+        search_index = app.extensions.get('search')
+        if search_index is not None and search_index.install(db.engine):
+            app.logger.info('Built %s search index', search_index.name)
+        # With preload_app the master runs this before forking; workers must
+        # not inherit its pooled connections.
+        db.engine.dispose()
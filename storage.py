@@ -0,0 +1,262 @@
+from flask import current_app
+from extensions import instrumentation
+import mimetypes
+import os
+import tempfile
+
+COPY_BUFFER = 1024 * 1024
+# S3 rejects multipart parts under 5 MiB, except the last one.
+PART_SIZE = 8 * 1024 * 1024
+BACKENDS = ('local', 's3')
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_full(stream, size):
+    # A single read() on a socket or a zip entry may return less than asked.
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(min(remaining, COPY_BUFFER))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+class LocalStorage:
+    # Keys are paths under root. Every backend keeps its working copies in
+    # the same layout, so for local storage the store and the cache are the
+    # same files.
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def size(self, key):
+        try:
+            return os.stat(self.path(key)).st_size
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def put_file(self, key, path):
+        # Takes ownership of path.
+        final_path = self.path(key)
+        directory = os.path.dirname(final_path)
+        os.makedirs(directory, exist_ok=True)
+        os.replace(path, final_path)
+        _fsync_dir(directory)
+
+    def put_stream(self, key, stream):
+        directory = os.path.dirname(self.path(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(COPY_BUFFER)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            self.put_file(key, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, key):
+        f = open(self.path(key), 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+    def local_path(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def presigned_url(self, key, content_type=None, disposition=None, cache_control=None):
+        return None
+
+    def keys(self, prefix=''):
+        for directory, _, files in os.walk(self.path(prefix)):
+            for name in files:
+                yield os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+
+
+class S3Storage:
+    # Any S3-compatible service; endpoint_url points it at MinIO or another
+    # stand-in. Decoding and analysis need real files, so objects are pulled
+    # into a local working copy on first use and uploads leave one behind.
+    name = 's3'
+
+    def __init__(self, bucket, cache_root, prefix='', endpoint_url=None, public_endpoint_url=None,
+                 region=None, presign_expires=3600, part_size=PART_SIZE):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError('STORAGE_BACKEND=s3 needs boto3: pip install boto3')
+        if not bucket:
+            raise RuntimeError('STORAGE_BACKEND=s3 needs STORAGE_S3_BUCKET')
+        self.boto3 = boto3
+        self.ClientError = ClientError
+        self.config = Config(signature_version='s3v4', max_pool_connections=32,
+                             s3={'addressing_style': 'path' if endpoint_url else 'auto'})
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.public_endpoint_url = public_endpoint_url
+        self.region = region
+        self.presign_expires = presign_expires
+        self.part_size = part_size
+        self.cache = LocalStorage(cache_root)
+        self.clients = None
+
+    def _clients(self):
+        # Made per process: a preloading gunicorn master must not hand its
+        # pooled connections to the workers it forks.
+        if self.clients is None or self.clients[0] != os.getpid():
+            client = self.boto3.session.Session().client(
+                's3', endpoint_url=self.endpoint_url, region_name=self.region, config=self.config)
+            presigner = client
+            if self.public_endpoint_url:
+                presigner = self.boto3.session.Session().client(
+                    's3', endpoint_url=self.public_endpoint_url, region_name=self.region, config=self.config)
+            self.clients = (os.getpid(), client, presigner)
+        return self.clients
+
+    @property
+    def client(self):
+        return self._clients()[1]
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))['ContentLength']
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def put_file(self, key, path):
+        # Takes ownership of path, which becomes the local working copy.
+        with open(path, 'rb') as f:
+            self.put_stream(key, f)
+        self.cache.put_file(key, path)
+
+    def put_stream(self, key, stream):
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        chunk = _read_full(stream, self.part_size)
+        if len(chunk) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=chunk, ContentType=content_type)
+            return
+        # Multipart keeps memory at one part however large the object is.
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self._key(key), ContentType=content_type)['UploadId']
+        parts = []
+        try:
+            while chunk:
+                number = len(parts) + 1
+                response = self.client.upload_part(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                                   PartNumber=number, Body=chunk)
+                parts.append({'ETag': response['ETag'], 'PartNumber': number})
+                chunk = _read_full(stream, self.part_size)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id)
+            raise
+
+    def open(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self.ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+        return response['Body'], response['ContentLength']
+
+    def local_path(self, key):
+        path = self.cache.path(key)
+        if not os.path.exists(path):
+            with instrumentation.storage('fetch') as op:
+                body, op.bytes = self.open(key)
+                try:
+                    self.cache.put_stream(key, body)
+                finally:
+                    body.close()
+        return path
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        self.cache.delete(key)
+
+    def presigned_url(self, key, content_type=None, disposition=None, cache_control=None):
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if disposition:
+            params['ResponseContentDisposition'] = disposition
+        if cache_control:
+            params['ResponseCacheControl'] = cache_control
+        return self._clients()[2].generate_presigned_url(
+            'get_object', Params=params, ExpiresIn=self.presign_expires)
+
+    def keys(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            for item in page.get('Contents', ()):
+                yield item['Key'][len(self.prefix):]
+
+
+def create_storage(config, backend=None):
+    backend = backend or config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(
+            config.get('STORAGE_S3_BUCKET'), config['UPLOAD_FOLDER'],
+            prefix=config.get('STORAGE_S3_PREFIX', ''),
+            endpoint_url=config.get('STORAGE_S3_ENDPOINT_URL'),
+            public_endpoint_url=config.get('STORAGE_S3_PUBLIC_ENDPOINT_URL'),
+            region=config.get('STORAGE_S3_REGION'),
+            presign_expires=config.get('STORAGE_PRESIGN_EXPIRES', 3600))
+    raise ValueError(f"STORAGE_BACKEND must be one of {', '.join(BACKENDS)}")
+
+
+def init_app(app):
+    app.extensions['storage'] = create_storage(app.config)
+
+
+def current():
+    return current_app.extensions['storage']
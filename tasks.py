@@ -0,0 +1,69 @@
+from flask import current_app
+from models import db, AudioFile, Blob, Loop, TeamUpload
+from jobs import task
+from extensions import cache
+from audio_io import DecodeError
+import beats
+import blobstore
+import jobs
+import mp3index
+import renditions
+import waveform
+
+
+@task('process_blob')
+def process_blob(blob_id):
+    blob = db.session.get(Blob, blob_id)
+    if blob is None:
+        return
+    path = blobstore.local_path(blob.filename)
+    index = mp3index.load_index(path)
+    AudioFile.query.filter_by(blob_id=blob_id, duration=None).update(
+        {AudioFile.duration: index.duration}, synchronize_session=False)
+    try:
+        waveform.ensure_peaks(path)
+    except DecodeError as e:
+        current_app.logger.warning('Could not decode %s for waveform: %s', blob.filename, e)
+
+
+@task('analyse_audio')
+def analyse_audio(audio_id):
+    audio = db.session.get(AudioFile, audio_id)
+    if audio is None:
+        return
+    result = beats.load_analysis(blobstore.local_path(audio.filename))
+    audio.tempo = result['tempo']
+    audio.revision = AudioFile.revision + 1
+    Loop.query.filter_by(audiofile_id=audio.id, auto=True).delete(synchronize_session=False)
+    for start, end, label in beats.suggest_loops(result, audio.duration):
+        db.session.add(Loop(audiofile_id=audio.id, start_time=start, end_time=end, label=label, auto=True))
+
+
+@task('analyse_team_folder')
+def analyse_team_folder(team_id, folder):
+    # One job per file, so the worker's process pool runs them in parallel
+    # instead of each folder job starting a pool of its own.
+    uploads = db.session.query(TeamUpload.id, TeamUpload.user_id, TeamUpload.blob_id).filter_by(
+        team_id=team_id, folder=folder)
+    for upload_id, user_id, blob_id in uploads:
+        jobs.enqueue('analyse_team_upload', user_id=user_id, blob_id=blob_id, upload_id=upload_id)
+
+
+@task('analyse_team_upload')
+def analyse_team_upload(upload_id, blob_id=None):
+    upload = db.session.get(TeamUpload, upload_id)
+    if upload is None:
+        return
+    upload.tempo = beats.load_analysis(blobstore.local_path(upload.filename))['tempo']
+    cache.invalidate(f'team-uploads:{upload.team_id}')
+
+
+@task('render_rendition')
+def render_rendition(audio_id, speed):
+    audio = db.session.get(AudioFile, audio_id)
+    if audio is None:
+        return
+    cache = renditions.cache_for(current_app.config)
+    key = renditions.cache_key(audio.filename)
+    if cache.lookup(key, speed) is None:
+        cache.build(blobstore.local_path(audio.filename), key, speed)
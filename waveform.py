@@ -0,0 +1,128 @@
+from audio_io import stream_pcm, file_info
+import numpy as np
+import os
+import struct
+
+MAGIC = b'DDMP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQ')
+LEVEL = struct.Struct('<QQ')
+BASE_SAMPLES_PER_PEAK = 256
+MIN_TOP_LEVEL_PEAKS = 512
+
+
+def peaks_path(path):
+    return os.path.splitext(path)[0] + '.peaks'
+
+
+def _base_peaks(path, sample_rate):
+    # Level 0 summarises every BASE_SAMPLES_PER_PEAK mono samples as
+    # (min, max, sum of squares); the remainder carries over between chunks.
+    mins, maxs, energy = [], [], []
+    carry = np.zeros(0, dtype=np.float32)
+    total = 0
+    for chunk in stream_pcm(path, channels=1, sample_rate=sample_rate):
+        total += len(chunk)
+        samples = np.concatenate((carry, chunk)) if len(carry) else chunk
+        whole = len(samples) - len(samples) % BASE_SAMPLES_PER_PEAK
+        blocks = samples[:whole].reshape(-1, BASE_SAMPLES_PER_PEAK)
+        mins.append(blocks.min(axis=1))
+        maxs.append(blocks.max(axis=1))
+        energy.append(np.einsum('ij,ij->i', blocks, blocks) / BASE_SAMPLES_PER_PEAK)
+        carry = samples[whole:]
+    if len(carry):
+        mins.append(carry.min(keepdims=True))
+        maxs.append(carry.max(keepdims=True))
+        energy.append(np.array([np.dot(carry, carry) / len(carry)], dtype=np.float32))
+    if not mins:
+        empty = np.zeros(0, dtype=np.float32)
+        return empty, empty, empty, 0
+    return np.concatenate(mins), np.concatenate(maxs), np.concatenate(energy), total
+
+
+def _downsample(mins, maxs, energy):
+    if len(mins) % 2:
+        mins = np.append(mins, mins[-1])
+        maxs = np.append(maxs, maxs[-1])
+        energy = np.append(energy, energy[-1])
+    return (mins.reshape(-1, 2).min(axis=1), maxs.reshape(-1, 2).max(axis=1),
+            energy.reshape(-1, 2).mean(axis=1))
+
+
+def _quantize(mins, maxs, energy):
+    packed = np.empty((len(mins), 3), dtype=np.int8)
+    packed[:, 0] = np.clip(np.round(mins * 127), -128, 127)
+    packed[:, 1] = np.clip(np.round(maxs * 127), -128, 127)
+    packed[:, 2] = np.clip(np.round(np.sqrt(energy) * 127), 0, 127)
+    return packed
+
+
+def build_peaks(path):
+    sample_rate = file_info(path).sample_rate
+    mins, maxs, energy, total = _base_peaks(path, sample_rate)
+    levels = [_quantize(mins, maxs, energy)]
+    while len(mins) > MIN_TOP_LEVEL_PEAKS:
+        mins, maxs, energy = _downsample(mins, maxs, energy)
+        levels.append(_quantize(mins, maxs, energy))
+    return sample_rate, total, levels
+
+
+def write_peaks(path):
+    sample_rate, total, levels = build_peaks(path)
+    sidecar = peaks_path(path)
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    offset = HEADER.size + LEVEL.size * len(levels)
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(levels), sample_rate, BASE_SAMPLES_PER_PEAK, total))
+        for level in levels:
+            f.write(LEVEL.pack(len(level), offset))
+            offset += level.nbytes
+        for level in levels:
+            f.write(level.tobytes())
+    os.replace(tmp_path, sidecar)
+    return sidecar
+
+
+def ensure_peaks(path):
+    sidecar = peaks_path(path)
+    if not os.path.exists(sidecar):
+        write_peaks(path)
+    return sidecar
+
+
+def read_window(sidecar, start_time, end_time, width):
+    with open(sidecar, 'rb') as f:
+        magic, version, level_count, sample_rate, base, total = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a peaks file')
+        levels = [LEVEL.unpack(f.read(LEVEL.size)) for _ in range(level_count)]
+        if not (sample_rate and base and levels):
+            # Nothing was decoded, so there is no timeline to index into.
+            return {'level': 0, 'levels': level_count, 'seconds_per_peak': 0.0, 'start': 0.0,
+                    'duration': 0.0, 'min': [], 'max': [], 'rms': []}
+        duration = total / sample_rate
+        start_time = min(max(start_time, 0.0), duration)
+        end_time = duration if end_time is None else min(max(end_time, start_time), duration)
+        # Pick the coarsest level that still has at least one peak per pixel.
+        level = 0
+        for candidate in range(level_count - 1, -1, -1):
+            seconds_per_peak = base * 2 ** candidate / sample_rate
+            if (end_time - start_time) / seconds_per_peak >= width:
+                level = candidate
+                break
+        count, offset = levels[level]
+        seconds_per_peak = base * 2 ** level / sample_rate
+        first = int(start_time / seconds_per_peak)
+        last = min(int(np.ceil(end_time / seconds_per_peak)), count)
+        f.seek(offset + first * 3)
+        data = np.frombuffer(f.read(max(last - first, 0) * 3), dtype=np.int8).reshape(-1, 3)
+    return {
+        'level': level,
+        'levels': level_count,
+        'seconds_per_peak': seconds_per_peak,
+        'start': first * seconds_per_peak,
+        'duration': duration,
+        'min': data[:, 0].tolist(),
+        'max': data[:, 1].tolist(),
+        'rms': data[:, 2].tolist(),
+    }
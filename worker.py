@@ -0,0 +1,86 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from main import create_app
+import chunked_uploads
+import jobs
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+stopping = False
+
+
+def _init_child():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    create_app().app_context().push()
+
+
+def _run_in_child(job_id):
+    return jobs.run(job_id)
+
+
+def _make_pool(processes):
+    return ProcessPoolExecutor(max_workers=processes, initializer=_init_child,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def _stop(signum, frame):
+    global stopping
+    stopping = True
+
+
+def main():
+    app = create_app()
+    processes = app.config['JOB_WORKERS']
+    poll = app.config['JOB_POLL_INTERVAL']
+    stale_after = app.config['JOB_STALE_AFTER']
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    with app.app_context():
+        app.logger.info('Job worker %s starting with %s processes', worker_id, processes)
+        pool = _make_pool(processes)
+        inflight = {}
+        last_recovery = 0.0
+        while not stopping or inflight:
+            if time.monotonic() - last_recovery > poll * 10:
+                recovered = jobs.recover_stale(stale_after)
+                if recovered:
+                    app.logger.warning('Requeued %s jobs from crashed workers', recovered)
+                expired = chunked_uploads.expire_stale()
+                if expired:
+                    app.logger.info('Discarded %s abandoned chunked uploads', expired)
+                last_recovery = time.monotonic()
+            jobs.heartbeat(list(inflight.values()))
+            if not stopping and len(inflight) < processes:
+                for job_id in jobs.claim(worker_id, processes - len(inflight)):
+                    inflight[pool.submit(_run_in_child, job_id)] = job_id
+            if not inflight:
+                time.sleep(poll)
+                continue
+            done, _ = wait(inflight, timeout=poll, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job_id = inflight.pop(future)
+                try:
+                    error = future.result()
+                except BrokenProcessPool:
+                    error = 'worker process crashed'
+                    broken = True
+                except Exception as e:
+                    error = repr(e)
+                jobs.finish(job_id, error)
+            if broken:
+                pool.shutdown(wait=False, cancel_futures=True)
+                for job_id in inflight.values():
+                    jobs.finish(job_id, 'worker process crashed')
+                inflight.clear()
+                pool = _make_pool(processes)
+        pool.shutdown()
+        app.logger.info('Job worker %s stopped', worker_id)
+
+
+if __name__ == '__main__':
+    main()